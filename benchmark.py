@@ -0,0 +1,534 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Some benchmarks, to compare the optimized parts of the program with their original implementation.
+Independent of the main program. Each benchmark also checks that both versions give the same results.
+
+Use python 3
+"""
+
+import argparse
+import glob
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import numpy as np
+
+import distributed
+
+from deepmusic.musicdata import MusicData
+from deepmusic.midiconnector import MidiConnector
+from deepmusic.midiconnector import MidiInvalidException
+from deepmusic.numpymodel import NumpyModel
+from deepmusic.pianoroll import PianoRoll
+import deepmusic.songstruct as music
+
+
+def _create_music_data():
+    """ Return a MusicData object without loaded dataset (only used for the conversions)
+    """
+    return MusicData(argparse.Namespace(test=True, note_range=list(music.MIDI_NOTES_RANGE)))
+
+
+def _create_random_song(nb_notes, nb_tracks=2):
+    """ Generate a song with random notes
+    Args:
+        nb_notes (int): the nb of notes by track
+        nb_tracks (int): the nb of tracks
+    Return:
+        Song: the generated song
+    """
+    song = music.Song()
+    for _ in range(nb_tracks):
+        track = music.Track()
+        for tick, note in zip(
+                np.sort(np.random.randint(0, 24*nb_notes, nb_notes)).tolist(),
+                np.random.randint(music.MIDI_NOTES_RANGE[0], music.MIDI_NOTES_RANGE[1]+1, nb_notes).tolist()):
+            new_note = music.Note()
+            new_note.tick = tick
+            new_note.note = note
+            track.notes.append(new_note)
+        song.tracks.append(track)
+    return song
+
+
+def _reference_song2array(music_data, song):
+    """ Original implementation of MusicData._convert_song2array (one note at the time)
+    """
+    song_length = len(song)
+    scale = music_data._get_scale(song)
+
+    piano_roll = np.zeros([music.NB_NOTES, int(np.ceil(song_length/scale))], dtype=int)
+    for track in song.tracks:
+        for note in track.notes:
+            piano_roll[note.get_relative_note()][note.tick//scale] = 1
+    return piano_roll
+
+
+def _reference_array2song(music_data, array):
+    """ Original implementation of MusicData._convert_array2song (loop over all the cells)
+    """
+    new_song = music.Song()
+    main_track = music.Track()
+
+    scale = music_data._get_scale(new_song)
+
+    for index, x in np.ndenumerate(array):
+        if x > 1e-12:
+            new_note = music.Note()
+            new_note.set_relative_note(index[0])
+            new_note.tick = index[1] * scale
+            main_track.notes.append(new_note)
+
+    new_song.tracks.append(main_track)
+    return new_song
+
+
+def _reference_create_batch(music_data, samples):
+    """ Original implementation of the batch creation (loop over the steps and batch_size)
+    """
+    samples = [song[:, start:start+music_data.args.sample_length+1] for song, start in samples]
+    inputs = []
+    targets = []
+    for i in range(music_data.args.sample_length):
+        input = -np.ones([len(samples), music.NB_NOTES])
+        target = np.zeros([len(samples), music.NB_NOTES])
+        for j, sample in enumerate(samples):
+            input[j, sample[:, i] == 1] = 1.0
+            target[j, sample[:, i+1] == 1] = 1.0
+        inputs.append(input)
+        targets.append(target)
+    return inputs, targets
+
+
+def _time(fct, repeat):
+    """ Return the best execution time of the given function (in seconds)
+    """
+    return min(timeit.repeat(fct, number=1, repeat=repeat))
+
+
+def _print_result(name, ref_time, new_time):
+    """ Print the comparison between the two versions
+    """
+    print('{}: {:.2f}ms -> {:.2f}ms (x{:.1f})'.format(name, ref_time*1000, new_time*1000, ref_time/new_time))
+
+
+def bench_conversion(args):
+    """ Compare the song <-> piano roll conversions
+    """
+    music_data = _create_music_data()
+
+    for nb_notes in args.sizes:
+        song = _create_random_song(nb_notes)
+        assert np.array_equal(music_data._convert_song2array(song).to_array(), _reference_song2array(music_data, song))
+        _print_result(
+            'song2array ({} notes)'.format(2*nb_notes),
+            _time(lambda: _reference_song2array(music_data, song), args.repeat),
+            _time(lambda: music_data._convert_song2array(song), args.repeat)
+        )
+
+    for length in args.sizes:
+        array = np.random.rand(music.NB_NOTES, length).astype(np.float32) - 0.9  # Predictions of a generated song (~10% notes)
+        notes = [(n.note, n.tick) for n in music_data._convert_array2song(array).tracks[0].notes]
+        assert notes == [(n.note, n.tick) for n in _reference_array2song(music_data, array).tracks[0].notes]
+        _print_result(
+            'array2song ({} steps)'.format(length),
+            _time(lambda: _reference_array2song(music_data, array), args.repeat),
+            _time(lambda: music_data._convert_array2song(array), args.repeat)
+        )
+
+
+def bench_batches(args):
+    """ Compare the batch creation
+    """
+    music_data = _create_music_data()
+    songs = [PianoRoll.from_array(np.random.rand(music.NB_NOTES, 2000) > 0.9) for _ in range(10)]
+
+    for batch_size in args.sizes:
+        music_data.args.batch_size = batch_size
+        music_data.args.sample_length = args.sample_length
+        samples = [(songs[np.random.randint(len(songs))], np.random.randint(2000 - args.sample_length)) for _ in range(batch_size)]
+
+        batch = music_data._create_batch(samples, args.sample_length)
+        inputs, targets = _reference_create_batch(music_data, samples)
+        assert np.array_equal(batch.inputs, inputs) and np.array_equal(batch.targets, targets)
+        _print_result(
+            'batch (batch_size={}, sample_length={})'.format(batch_size, args.sample_length),
+            _time(lambda: _reference_create_batch(music_data, samples), args.repeat),
+            _time(lambda: music_data._create_batch(samples, args.sample_length), args.repeat)
+        )
+
+
+def _create_model_args(args, graph, sample_length, test=None, hidden_size=256, num_layers=2, num_towers=1):
+    """ Return the parameters of a model for the graph benchmarks (default network options)
+    """
+    return argparse.Namespace(
+        test=test,
+        graph=graph,
+        device=None,
+        num_towers=num_towers,
+        sample_length=sample_length,
+        buckets=[sample_length],
+        batch_size=args.batch_size,
+        note_range=list(music.MIDI_NOTES_RANGE),
+        hidden_size=hidden_size,
+        num_layers=num_layers,
+        pack_songs=False,
+        scheduled_sampling=['none'],
+        target_weights='linear',
+        learning_rate=['cst', '0.0001'],
+    )
+
+
+def bench_graph(args):
+    """ Compare the unrolled graph with the dynamic one: graph creation time and training steps/sec
+    Here, the sizes are the sequence lengths (ex: --sizes 40 100 400)
+    """
+    import tensorflow as tf  # Only required by this benchmark
+    from deepmusic.model_old import Model
+
+    music_data = _create_music_data()
+    songs = [PianoRoll.from_array(np.random.rand(music.NB_NOTES, 2000) > 0.9) for _ in range(10)]
+
+    for sample_length in args.sizes:
+        samples = [(songs[np.random.randint(len(songs))], np.random.randint(2000 - sample_length)) for _ in range(args.batch_size)]
+        batch = music_data._create_batch(samples, sample_length)
+
+        build_times = []
+        step_times = []
+        for graph in [Model.GraphMode.STATIC, Model.GraphMode.DYNAMIC]:
+            with tf.Graph().as_default():
+                tic = time.perf_counter()
+                model = Model(_create_model_args(args, graph, sample_length))
+                build_times.append(time.perf_counter() - tic)
+
+                with tf.Session() as sess:
+                    sess.run(tf.initialize_all_variables())
+                    sess.run(*model.step(batch, glob_step=0))  # Warm-up
+                    step_times.append(_time(lambda: sess.run(*model.step(batch, glob_step=0)), args.repeat))  # Include the feeding
+
+        _print_result('graph creation ({} steps)'.format(sample_length), *build_times)
+        _print_result('training step ({} steps, batch_size={})'.format(sample_length, args.batch_size), *step_times)
+        print('static: {:.1f} steps/sec, dynamic: {:.1f} steps/sec'.format(1/step_times[0], 1/step_times[1]))
+
+
+def bench_towers(args):
+    """ Measure how the training throughput scales with the number of towers (data parallelism on the cpu cores)
+    Here, the sizes are the numbers of towers (ex: --sizes 1 2 4 8), the batch is split between them
+    """
+    import tensorflow as tf  # Only required by this benchmark
+    from deepmusic.model_old import Model
+
+    music_data = _create_music_data()
+    songs = [PianoRoll.from_array(np.random.rand(music.NB_NOTES, 2000) > 0.9) for _ in range(10)]
+    samples = [(songs[np.random.randint(len(songs))], np.random.randint(2000 - args.sample_length)) for _ in range(args.batch_size)]
+    batch = music_data._create_batch(samples, args.sample_length)
+
+    step_times = []
+    for num_towers in args.sizes:
+        if args.batch_size % num_towers:
+            print('Warning: batch_size={} not divisible by {} towers, skipped'.format(args.batch_size, num_towers))
+            continue
+        with tf.Graph().as_default():
+            model = Model(_create_model_args(args, Model.GraphMode.DYNAMIC, args.sample_length, num_towers=num_towers))
+
+            config = tf.ConfigProto()
+            config.device_count['CPU'] = num_towers
+            with tf.Session(config=config) as sess:
+                sess.run(tf.initialize_all_variables())
+                sess.run(*model.step(batch, glob_step=0))  # Warm-up
+                step_times.append(_time(lambda: sess.run(*model.step(batch, glob_step=0)), args.repeat))
+
+        print('{} tower(s): {:.1f} steps/sec, {:.0f} samples/sec (x{:.2f})'.format(
+            num_towers,
+            1 / step_times[-1],
+            args.batch_size / step_times[-1],
+            step_times[0] / step_times[-1]  # Relative to the first configuration
+        ))
+
+
+def _run_distributed_task(args):
+    """ Process of the distributed benchmark: parameter server, or worker training on random batches
+    """
+    import tensorflow as tf  # Only required by this benchmark
+    from deepmusic.model_old import Model
+
+    cluster = tf.train.ClusterSpec({'ps': args.ps_hosts, 'worker': args.worker_hosts})
+    server = tf.train.Server(cluster, job_name=args.job_name, task_index=args.task_index)
+    if args.job_name == 'ps':
+        server.join()  # Killed by the main process
+        return
+
+    with tf.device(tf.train.replica_device_setter(worker_device='/job:worker/task:{}'.format(args.task_index), cluster=cluster)):
+        model = Model(_create_model_args(args, Model.GraphMode.DYNAMIC, args.sample_length))
+
+    music_data = _create_music_data()
+    songs = [PianoRoll.from_array(np.random.rand(music.NB_NOTES, 2000) > 0.9) for _ in range(10)]
+    samples = [(songs[np.random.randint(len(songs))], np.random.randint(2000 - args.sample_length)) for _ in range(args.batch_size)]
+    batch = music_data._create_batch(samples, args.sample_length)
+
+    with tf.Session(server.target) as sess:
+        if args.task_index == 0:  # Chief
+            sess.run(tf.initialize_all_variables())
+        else:
+            uninitialized_variables = tf.report_uninitialized_variables()
+            while len(sess.run(uninitialized_variables)):
+                time.sleep(0.1)
+
+        sess.run(*model.step(batch, glob_step=0))  # Warm-up
+        tic = time.perf_counter()
+        for i in range(args.nb_steps):
+            sess.run(*model.step(batch, glob_step=i))
+        print('steps/sec: {}'.format(args.nb_steps / (time.perf_counter() - tic)))
+
+
+def bench_distributed(args):
+    """ Measure the training throughput of a distributed training (localhost processes, one parameter server)
+    Here, the sizes are the numbers of workers (ex: --sizes 1 2 4), the throughput is the sum of the workers ones
+    """
+    if args.job_name:  # Process launched by the benchmark
+        _run_distributed_task(args)
+        return
+
+    total_steps = []
+    for nb_workers in args.sizes:
+        script_args = [
+            sys.executable, os.path.abspath(__file__), 'distributed',
+            '--sample_length', str(args.sample_length),
+            '--batch_size', str(args.batch_size),
+            '--nb_steps', str(args.nb_steps),
+        ]
+        ps_processes, worker_processes = distributed.launch_cluster(script_args, nb_workers, stdout=subprocess.PIPE)
+        try:
+            outputs = [process.communicate()[0].decode() for process in worker_processes]
+        finally:
+            for process in ps_processes:
+                process.kill()
+        if any(process.returncode for process in worker_processes):
+            raise RuntimeError('A worker of the distributed benchmark failed (see its error above)')
+
+        steps = [float(re.search(r'steps/sec: ([0-9.]+)', output).group(1)) for output in outputs]
+        total_steps.append(sum(steps))
+        print('{} worker(s): {:.1f} steps/sec, {:.0f} samples/sec (x{:.2f}, {:.1f} steps/sec by worker)'.format(
+            nb_workers,
+            total_steps[-1],
+            total_steps[-1] * args.batch_size,
+            total_steps[-1] / total_steps[0],  # Relative to the first configuration
+            total_steps[-1] / nb_workers
+        ))
+
+
+def bench_latency(args):
+    """ Measure the latency of the single step generation (one frame at the time, batch of 1, state fed by the host)
+    Here, the sizes are the hidden sizes (ex: --sizes 128 256 512)
+    """
+    import tensorflow as tf  # Only required by this benchmark
+    from deepmusic.model_old import Model
+
+    for num_layers in args.num_layers:
+        for hidden_size in args.sizes:
+            with tf.Graph().as_default():
+                model = Model(_create_model_args(
+                    args,
+                    Model.GraphMode.DYNAMIC,  # Smallest graph (the step ops are the same for both modes)
+                    sample_length=2,
+                    test='all',
+                    hidden_size=hidden_size,
+                    num_layers=num_layers
+                ))
+
+                with tf.Session() as sess:
+                    sess.run(tf.initialize_all_variables())
+
+                    keyboard = -np.ones([1, music.NB_NOTES], dtype=np.float32)
+                    state = model.get_zero_state(1)
+                    step_times = []
+                    for i in range(args.nb_steps + 10):
+                        tic = time.perf_counter()
+                        ops, feed_dict = model.single_step(keyboard, state)  # Include the feeding
+                        _, keyboard, state = sess.run(ops, feed_dict)
+                        if i >= 10:  # Warm-up
+                            step_times.append(time.perf_counter() - tic)
+
+            step_times = np.asarray(step_times) * 1000
+            print('single step (hidden_size={}, num_layers={}): p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms'.format(
+                hidden_size,
+                num_layers,
+                np.percentile(step_times, 50),
+                np.percentile(step_times, 99),
+                np.max(step_times)
+            ))
+
+
+def _create_random_model(filename, hidden_size, num_layers=2):
+    """ Export a network with random weights (same initialization scales as the TensorFlow model)
+    """
+    variables = {
+        NumpyModel.PROJECTION_VARIABLE.format('weights'): np.random.randn(hidden_size, music.NB_NOTES).astype(np.float32),
+        NumpyModel.PROJECTION_VARIABLE.format('bias'): np.random.randn(music.NB_NOTES).astype(np.float32),
+    }
+    for l in range(num_layers):
+        nb_inputs = (music.NB_NOTES if l == 0 else hidden_size) + hidden_size
+        limit = np.sqrt(3.0 / nb_inputs)  # Uniform unit scaling (default initializer of the variables)
+        variables[NumpyModel.LSTM_VARIABLE.format(l, 'Matrix')] = np.random.uniform(-limit, limit, [nb_inputs, 4*hidden_size]).astype(np.float32)
+        variables[NumpyModel.LSTM_VARIABLE.format(l, 'Bias')] = np.zeros([4*hidden_size], dtype=np.float32)
+    NumpyModel.export(variables, filename, list(music.MIDI_NOTES_RANGE), 200)
+
+
+def bench_quantization(args):
+    """ Compare the int8 quantized generation with the float one: agreement of the generated notes for each
+    initiator, time by generated step and size of the stored weights (the quantized weights are converted to float
+    when loaded, so the time and the memory read by step are the ones of the float model)
+    The exported models are given with --models (by default, random networks, the sizes are then the hidden sizes)
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        model_list = args.models
+        if not model_list:
+            model_list = []
+            for hidden_size in args.sizes:
+                model_list.append(os.path.join(tmp_dir, 'random-{}.npz'.format(hidden_size)))
+                _create_random_model(model_list[-1], hidden_size)
+
+        for model_name in model_list:
+            quantized_name = os.path.join(tmp_dir, 'quantized.npz')
+            NumpyModel.quantize(model_name, quantized_name)
+            model = NumpyModel(model_name)
+            quantized_model = NumpyModel(quantized_name)
+            print('{} (hidden_size={}, num_layers={})'.format(os.path.basename(model_name), model.hidden_size, model.num_layers))
+
+            batch, names = MusicData(argparse.Namespace(test=True, note_range=model.note_range)).get_batches_test()
+            generate = lambda m: m.generate(batch.inputs, batch.initiator_lengths, args.sample_length)
+            outputs = generate(model) > 0  # Played notes (sigmoid > 0.5)
+            quantized_outputs = generate(quantized_model) > 0
+            for i, name in enumerate(names):
+                notes = outputs[:, i]
+                quantized_notes = quantized_outputs[:, i]
+                nb_union = np.sum(notes | quantized_notes)
+                print('  {}: {:.2%} of the keyboard identical, {:.2%} of the notes in common ({} -> {} notes)'.format(
+                    name,
+                    np.mean(notes == quantized_notes),
+                    np.sum(notes & quantized_notes) / nb_union if nb_union else 1.0,
+                    np.sum(notes),
+                    np.sum(quantized_notes)
+                ))
+
+            nb_steps = args.sample_length
+            _print_result(
+                '  time by step (batch_size={})'.format(len(names)),
+                _time(lambda: generate(model), args.repeat) / nb_steps,
+                _time(lambda: generate(quantized_model), args.repeat) / nb_steps
+            )
+            print('  stored model size: {:.1f}KB -> {:.1f}KB (x{:.1f})'.format(
+                model.stored_nbytes / 1024,
+                quantized_model.stored_nbytes / 1024,
+                model.stored_nbytes / quantized_model.stored_nbytes
+            ))
+            print('  weights read by step: {:.1f}KB -> {:.1f}KB'.format(model.nbytes / 1024, quantized_model.nbytes / 1024))
+
+
+def _load_song_summary(filename, fast):
+    """ Load the midi file and summarize its content, to compare the two parsers
+    Return:
+        Tuple: the song attributes, or the exception message if the file is invalid
+    """
+    try:
+        song = MidiConnector.load_file(filename, fast=fast)
+    except MidiInvalidException as e:
+        return 'MidiInvalidException', str(e)
+    return (
+        song.ticks_per_beat,
+        [(m.tempo, m.time) for m in song.tempo_map],
+        [(t.instrument, t.is_drum, [(n.tick, n.note, n.duration) for n in t.notes]) for t in song.tracks]
+    )
+
+
+def bench_midi_parser(args):
+    """ Compare the fast midi parser with the mido one (differential testing on all the files of the given folder)
+    """
+    midi_files = sorted(glob.glob(os.path.join(args.midi_dir, '*.mid')))
+    if not midi_files:
+        raise ValueError('No midi file found in {}'.format(args.midi_dir))
+
+    nb_errors = 0
+    for filename in midi_files:
+        ref = _load_song_summary(filename, fast=False)
+        new = _load_song_summary(filename, fast=True)
+        if ref[0] == 'MidiInvalidException':  # The error messages may differ for the unsupported messages
+            is_same = new[0] == 'MidiInvalidException'
+        else:
+            is_same = ref == new
+        if not is_same:
+            nb_errors += 1
+            print('Mismatch for {}: {} / {}'.format(filename, str(ref)[:100], str(new)[:100]))
+    print('{} files compared, {} mismatches'.format(len(midi_files), nb_errors))
+
+    _print_result(
+        'load_file ({} files)'.format(len(midi_files)),
+        _time(lambda: [_load_song_summary(f, fast=False) for f in midi_files], args.repeat),
+        _time(lambda: [_load_song_summary(f, fast=True) for f in midi_files], args.repeat)
+    )
+
+
+def main():
+    benchmarks = {
+        'conversion': bench_conversion,
+        'midi_parser': bench_midi_parser,
+        'batches': bench_batches,
+        'graph': bench_graph,
+        'towers': bench_towers,
+        'distributed': bench_distributed,
+        'latency': bench_latency,
+        'quantization': bench_quantization,
+    }
+
+    default_sizes = {  # The meaning of the sizes depends on the benchmark
+        'towers': [1, 2, 4],
+        'distributed': [1, 2, 4],
+        'latency': [128, 256, 512],
+        'quantization': [128, 256, 512],
+    }
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', choices=benchmarks.keys(), help='the benchmark to run')
+    parser.add_argument('--sizes', type=int, nargs='+', default=None, help='sizes of the tested inputs (depends on the benchmark, see its description)')
+    parser.add_argument('--sample_length', type=int, default=200, help='length of the sequences')
+    parser.add_argument('--batch_size', type=int, default=10, help='batch size of the graph benchmark')
+    parser.add_argument('--num_layers', type=int, nargs='+', default=[1, 2, 3], help='nb of layers of the networks tested by the latency benchmark')
+    parser.add_argument('--nb_steps', type=int, default=1000, help='nb of generated time steps for the latency benchmark')
+    parser.add_argument('--models', type=str, nargs='+', default=None, help='exported models (.npz) compared by the quantization benchmark (random networks if not set)')
+    parser.add_argument('--midi_dir', type=str, default='data/midi/ragtimemusic', help='folder containing the midi files to parse')
+    parser.add_argument('--repeat', type=int, default=5, help='nb of times each measure is repeated (the best one is kept)')
+    # Internal options, used by the processes of the distributed benchmark
+    parser.add_argument('--job_name', type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--task_index', type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument('--ps_hosts', type=str, nargs='+', default=[], help=argparse.SUPPRESS)
+    parser.add_argument('--worker_hosts', type=str, nargs='+', default=[], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.sizes is None:
+        args.sizes = default_sizes.get(args.benchmark, [100, 1000, 10000])
+
+    np.random.seed(0)
+    benchmarks[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Write the checkpoints in background while the model is training
+
+"""
+
+import collections
+import concurrent.futures  # Background writer
+import os
+
+import tensorflow as tf
+
+
+class Checkpointer:
+    """ Save the variables without blocking the training
+    Each save first copies the variables into shadow variables (an in-graph copy, as fast as a training step), then the
+    shadow variables are written by a background thread while the training continues on the original ones. The
+    checkpoint is written under a temporary name and renamed once complete, so an interruption never leaves a
+    corrupted model. At most `nb_pending` saves are in progress (one set of shadow variables for each): when they
+    are all pending, the next save waits for the oldest one to be written.
+    The shadow variables are saved under the name of the original ones, so the checkpoints are restored as usual by
+    a tf.train.Saver of the model.
+    """
+    def __init__(self, variables, nb_pending=1):
+        """ Has to be created before the variables initialization (the shadow variables need to be initialized too)
+        and after the Saver of the model (the shadow variables should not be part of the restored ones)
+        Args:
+            variables (List[tf.Variable]): the variables to save
+            nb_pending (int): nb of saves which can be in progress at the same time (0 to save synchronously)
+        """
+        self.nb_pending = nb_pending
+        self.nb_saves = 0
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(1) if nb_pending > 0 else None  # Single writer, so the saves are written in order
+        self.queue = collections.deque()  # The saves in progress (futures)
+
+        # Copy and saver of each slot (the slot of a save is the one of the oldest pending save)
+        self.snapshot_ops = []
+        self.savers = []
+        if nb_pending == 0:  # The original variables are directly saved
+            self.snapshot_ops.append(None)
+            self.savers.append(tf.train.Saver(variables, max_to_keep=None))
+        for i in range(nb_pending):
+            with tf.name_scope('checkpoint_slot_{}'.format(i)):
+                shadows = {}
+                copies = []
+                for variable in variables:
+                    with tf.device(variable.device):  # The copy stays local
+                        shadow = tf.Variable(
+                            tf.zeros(variable.get_shape().as_list(), dtype=variable.dtype.base_dtype),
+                            trainable=False,
+                            name=variable.op.name
+                        )
+                    shadows[variable.op.name] = shadow  # Saved under the original name
+                    copies.append(tf.assign(shadow, variable))
+                self.snapshot_ops.append(tf.group(*copies))
+                self.savers.append(tf.train.Saver(shadows, max_to_keep=None))
+
+    def save(self, sess, model_name, write_metadata=None):
+        """ Snapshot the variables and launch the writing of the checkpoint
+        Args:
+            sess: the current session (also used by the background thread, the sessions are thread safe)
+            model_name (str): the path of the checkpoint
+            write_metadata (fct): called once the checkpoint is written (by the background thread), to save the files
+                which have to match it (params, training state,...)
+        """
+        while len(self.queue) >= max(1, self.nb_pending) or (self.queue and self.queue[0].done()):
+            self.queue[0].result()  # Wait for a free slot (and raise the errors of the previous saves)
+            self.queue.popleft()  # Only once written (still flushed if interrupted while waiting)
+
+        slot = self.nb_saves % len(self.savers)
+        self.nb_saves += 1
+        if self.snapshot_ops[slot] is not None:
+            sess.run(self.snapshot_ops[slot])
+
+        if self.executor is None:  # Synchronous mode
+            self._write(sess, self.savers[slot], model_name, write_metadata)
+        else:
+            self.queue.append(self.executor.submit(self._write, sess, self.savers[slot], model_name, write_metadata))
+
+    @staticmethod
+    def _write(sess, saver, model_name, write_metadata):
+        """ Write the checkpoint and its associated files
+        Only the variables are written (no meta graph nor 'checkpoint' index file, the models are restored by name), the
+        old checkpoints are not deleted here (see Composer._prune_models)
+        """
+        tmp_name = model_name + '.tmp'
+        sess.run(saver.saver_def.save_tensor_name, {saver.saver_def.filename_tensor_name: tmp_name})
+        os.replace(tmp_name, model_name)  # Atomic
+        if write_metadata is not None:
+            write_metadata()
+
+    def flush(self):
+        """ Wait until all pending saves are written
+        """
+        while self.queue:
+            self.queue[0].result()
+            self.queue.popleft()
+
+    def close(self):
+        """ Write the pending saves and stop the background thread
+        """
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
@@ -23,16 +23,22 @@ import argparse  # Command line parsing
 import configparser  # Saving the models parameters
 import datetime  # Chronometer
 import os  # Files management
+import pickle  # Saving the training state
+import time
 from typing import Dict, Tuple, List
 from tqdm import tqdm  # Progress bar
+import numpy as np
 import tensorflow as tf
-import gc
 
-from deepmusic.musicdata import MusicData
+from deepmusic.musicdata import MusicData, Batch
 from deepmusic.midiconnector import MidiConnector
 from deepmusic.imgconnector import ImgConnector
 from deepmusic.model_old import Model
+from deepmusic.numpymodel import NumpyModel
+from deepmusic.executionprofile import ExecutionProfile
+from deepmusic.checkpointer import Checkpointer
 from deepmusic.keyboardcell import KeyboardCell
+import deepmusic.songstruct as music
 
 
 class Composer:
@@ -45,13 +51,14 @@ class Composer:
         """
         ALL = 'all'  # The network try to generate a new original composition with all models present (with the tag)
         DAEMON = 'daemon'  # Runs on background and can regularly be called to predict something (Not implemented)
+        EXPORT = 'export'  # Save the weights of all models for the numpy generation (see generate.py)
 
         @staticmethod
         def get_test_modes() -> List[str]:
             """ Return the list of the different testing modes
             Useful on when parsing the command lines arguments
             """
-            return [Composer.TestMode.ALL, Composer.TestMode.DAEMON]
+            return [Composer.TestMode.ALL, Composer.TestMode.DAEMON, Composer.TestMode.EXPORT]
 
     def __init__(self):
         """
@@ -67,16 +74,32 @@ class Composer:
         self.writer = None
         self.writer_test = None
         self.saver = None
+        self.checkpointer = None  # Write the checkpoints in background (training only)
         self.model_dir = ''  # Where the model is saved
         self.glob_step = 0  # Represent the number of iteration for the current model
 
+        # Training progression (saved with each checkpoint, so an interrupted training can be resumed at the next batch)
+        self.epoch = 0  # Nb of completed epochs
+        self.epoch_step = 0  # Nb of batches done on the current epoch
+        self.sampler_states = {}  # State of the train/test samplers after the last used batches
+        self.random_state = None  # State of np.random after the last training step (used by the scheduled sampling)
+
         # TensorFlow main session (we keep track for the daemon)
         self.sess = None
 
+        # Distributed training (None if the training runs on a single process)
+        self.cluster = None
+        self.server = None
+        self.is_chief = True  # Only the chief worker initialize/restore the model and save the checkpoints and summaries
+        self.model_ready = None  # Set by the chief once the model is initialized and restored
+
         # Filename and directories constants
         self.MODEL_DIR_BASE = 'save/model'
         self.MODEL_NAME_BASE = 'model'
         self.MODEL_EXT = '.ckpt'
+        self.MAX_TO_KEEP = 200  # With keep_all, the oldest models are deleted beyond this limit (set the arbitrary limit ?)
+        self.EXPORT_EXT = '.npz'  # Weights for the numpy generation
+        self.TRAINING_STATE_EXT = '.state'  # Added to the model name
         self.CONFIG_FILENAME = 'params.ini'
         self.CONFIG_VERSION = '0.3'  # Ensure to raise a warning if there is a change in the format
 
@@ -84,6 +107,8 @@ class Composer:
         self.TRAINING_VISUALIZATION_DIR = 'progression'
         self.TESTING_VISUALIZATION_DIR = 'midi'  # Would 'generated', 'output' or 'testing' be a best folder name ?
 
+        self.TUNING_STEPS = 10  # Nb of training steps measured for each configuration of the session tuning
+
     @staticmethod
     def _parse_args(args):
         """
@@ -101,11 +126,15 @@ class Composer:
                                       ' the defined model(s), in interactive mode, the user can wrote his own sentences,'
                                       ' use daemon mode to integrate the chatbot in another program')
         global_args.add_argument('--reset', action='store_true', help='use this if you want to ignore the previous model present on the model directory (Warning: the model will be destroyed with all the folder content)')
-        global_args.add_argument('--keep_all', action='store_true', help='if this option is set, all saved model will be keep (Warning: make sure you have enough free disk space or increase save_every)')  # TODO: Add an option to delimit the max size
+        global_args.add_argument('--keep_all', action='store_true', help='if this option is set, the saved models are not overwritten (the step is added to the name, only the 200 last ones are kept) (Warning: make sure you have enough free disk space or increase save_every)')  # TODO: Add an option to delimit the max size
         global_args.add_argument('--model_tag', type=str, default=None, help='tag to differentiate which model to store/load')
         global_args.add_argument('--sample_length', type=int, default=40, help='number of time units (steps) of a training sentence, length of the sequence to generate')  # Warning: the unit is defined by the MusicData.MAXIMUM_SONG_RESOLUTION parameter
+        global_args.add_argument('--generate_length', type=int, default=None, help='number of time steps of the generated songs (the network is run by chunks of sample_length steps, so the songs can be longer), sample_length if not set')
         global_args.add_argument('--root_dir', type=str, default=None, help='folder where to look for the models and data')
         global_args.add_argument('--device', type=str, default=None, help='\'gpu\' or \'cpu\' (Warning: make sure you have enough free RAM), allow to choose on which hardware run the model')
+        global_args.add_argument('--tune_session', action='store_true', help='if set, the training step is benchmarked under a grid of thread pools settings (and batch sizes, see --tune_batch_sizes), the fastest configuration is saved next to the model params and used by all the next sessions of the model')
+        global_args.add_argument('--tune_batch_sizes', type=int, nargs='+', default=None, help='batch sizes tested by --tune_session (only reported, the thread settings are chosen for the model batch size)')
+        global_args.add_argument('--graph', choices=Model.GraphMode.get_modes(), default=Model.GraphMode.STATIC, help='static: one placeholder and unrolled cell by time step, dynamic: single tensors and a while loop over the time steps (faster to build and feed, the checkpoints are compatible)')
 
         # Dataset options
         dataset_args = parser.add_argument_group('Dataset options')
@@ -113,6 +142,13 @@ class Composer:
         dataset_args.add_argument('--create_dataset', action='store_true', help='if present, the program will only generate the dataset from the corpus (no training/testing)')
         dataset_args.add_argument('--play_dataset', type=int, nargs='?', const=10, default=None,  help='if set, the program  will randomly play some samples(can be use conjointly with create_dataset if this is the only action you want to perform)')  # TODO: Play midi ? / Or show sample images ? Both ?
         dataset_args.add_argument('--ratio_dataset', type=float, default=0.9, help='ratio of songs between training/testing')
+        dataset_args.add_argument('--midi_parser', choices=['mido', 'fast'], default='mido', help='parser used to read the midi files when creating the dataset (the fast parser decodes the files directly, mido is the reference implementation)')
+        dataset_args.add_argument('--dataset_workers', type=int, default=1, help='number of processes used to parse the midi files when creating the dataset (0 for one per cpu core)')
+        dataset_args.add_argument('--prefetch', type=int, default=4, help='number of batches prepared in advance while training (0 to create each batch only when needed)')
+        dataset_args.add_argument('--batch_workers', type=int, default=1, help='number of threads creating the batches in background')
+        dataset_args.add_argument('--crop_keyboard', action='store_true', help='if set, a new model only uses the keys played on the dataset instead of the full piano keyboard (smaller and faster network)')
+        dataset_args.add_argument('--transpose', type=int, default=0, help='data augmentation: the training extracts are randomly transposed of up to x semitones (in both directions)')
+        dataset_args.add_argument('--pack_songs', action='store_true', help='if set, the songs are concatenated and cut into consecutive extracts (the short songs are used and the RNN state is reset between songs)')
 
         # Network options (Warning: if modifying something here, also make the change on save/restore_params() )
         nn_args = parser.add_argument_group('Network options', 'architecture related option')
@@ -127,11 +163,22 @@ class Composer:
         # Training options (Warning: if modifying something here, also make the change on save/restore_params() )
         training_args = parser.add_argument_group('Training options')
         training_args.add_argument('--num_epochs', type=int, default=0, help='maximum number of epochs to run (0 for infinity)')
+        training_args.add_argument('--epochless', action='store_true', help='draw the training extracts indefinitely instead of by epochs (the checkpoints and learning rate only depend on the global step)')
         training_args.add_argument('--save_every', type=int, default=1000, help='nb of mini-batch step before creating a model checkpoint')
+        training_args.add_argument('--async_saves', type=int, default=1, help='nb of checkpoints which can be written in background at the same time (each one keeps a copy of the variables in memory, the training waits when they are all pending), 0 to save synchronously')
         training_args.add_argument('--batch_size', type=int, default=10, help='mini-batch size')
+        training_args.add_argument('--num_towers', type=int, default=1, help='data parallelism: each batch is split between x replicas of the network (one by cpu core, or by gpu with --device gpu), the gradients are combined before the update (the batch size has to be a multiple)')
+        training_args.add_argument('--buckets', type=int, nargs='+', default=None, help='train on several sequence lengths (each batch uses one of them, the weights are shared), sample_length if not set')
         training_args.add_argument('--learning_rate', type=str, nargs='+', default=[Model.LearningRatePolicy.CST, '0.0001'], help='Learning rate (available: {})'.format(Model.LearningRatePolicy.get_policies()))
         training_args.add_argument('--testing_curve', type=int, default=10, help='Also record the testing curve each every x iteration (given by the parameter)')
 
+        # Distributed options (training on several processes, see distributed.py to launch them all on localhost)
+        distributed_args = parser.add_argument_group('Distributed options', 'asynchronous training with parameter servers')
+        distributed_args.add_argument('--job_name', choices=['ps', 'worker'], default=None, help='if set, the process is part of a distributed training: a parameter server (holds the variables) or a worker (trains on its part of the training set)')
+        distributed_args.add_argument('--task_index', type=int, default=0, help='index of the process in its job (the worker 0 is the chief)')
+        distributed_args.add_argument('--ps_hosts', type=str, nargs='+', default=[], help='hostname:port of each parameter server')
+        distributed_args.add_argument('--worker_hosts', type=str, nargs='+', default=[], help='hostname:port of each worker')
+
         return parser.parse_args(args)
 
     def main(self, args=None):
@@ -150,7 +197,17 @@ class Composer:
         if not self.args.root_dir:
             self.args.root_dir = os.getcwd()  # Use the current working directory
 
+        if self.args.job_name:
+            self._start_server()
+            if self.args.job_name == 'ps':
+                print('Parameter server {} started, waiting for the workers...'.format(self.args.task_index))
+                self.server.join()  # Never returns (the process has to be killed)
+                return
+
         self._restore_params()  # Update the self.model_dir and self.glob_step, for now, not used when loading Model
+        self.args.buckets = sorted(set(self.args.buckets or [self.args.sample_length]))  # Sequence lengths used for training
+        if not self.args.test and self.args.batch_size % self.args.num_towers:
+            raise ValueError('The batch size ({}) has to be a multiple of the number of towers ({})'.format(self.args.batch_size, self.args.num_towers))
         self._print_params()
 
         self.music_data = MusicData(self.args)
@@ -158,13 +215,27 @@ class Composer:
             print('Dataset created! You can start training some models.')
             return  # No need to go further
 
+        if self.args.note_range is None:  # New model (otherwise, the range is restored with the params)
+            self.args.note_range = self.music_data.note_range if self.args.crop_keyboard else list(music.MIDI_NOTES_RANGE)
+        print('Keyboard: midi notes {} to {}'.format(*self.args.note_range))
+
+        if self.args.tune_session:
+            self._tune_session()
+            return  # No need to go further
+
         with tf.device(self._get_device()):
             self.model = Model(self.args)
 
         # Saver/summaries
-        self.writer = tf.train.SummaryWriter(os.path.join(self.model_dir, 'train'))
-        self.writer_test = tf.train.SummaryWriter(os.path.join(self.model_dir, 'test'))
-        self.saver = tf.train.Saver(max_to_keep=200)  # Set the arbitrary limit ?
+        if self.is_chief:
+            self.writer = tf.train.SummaryWriter(os.path.join(self.model_dir, 'train'))
+            self.writer_test = tf.train.SummaryWriter(os.path.join(self.model_dir, 'test'))
+        self.saver = tf.train.Saver(max_to_keep=self.MAX_TO_KEEP)  # Only used to restore (see Checkpointer for the saves)
+        if self.cluster:  # After the saver (not part of the checkpoints)
+            with tf.device(self._get_device()):  # On the parameter servers, shared by all workers
+                self.model_ready = tf.Variable(False, trainable=False, name='model_ready')
+        if self.is_chief and not self.args.test:  # After the saver (the copies of the variables are not restored)
+            self.checkpointer = Checkpointer(tf.all_variables(), self.args.async_saves)
 
         # TODO: Fixed seed (WARNING: If dataset shuffling, make sure to do that after saving the
         # dataset, otherwise, all what comes after the shuffling won't be replicable when
@@ -173,17 +244,24 @@ class Composer:
 
         # Running session
 
-        self.sess = tf.Session()
+        self.sess = tf.Session(self.server.target if self.server else '', config=self._get_session_config())
 
-        print('Initialize variables...')
-        self.sess.run(tf.initialize_all_variables())
+        if self.is_chief:
+            print('Initialize variables...')
+            self.sess.run(tf.initialize_all_variables())
 
-        # Reload the model eventually (if it exist), on testing mode, the models are not loaded here (but in main_test())
-        self._restore_previous_model(self.sess)
+            # Reload the model eventually (if it exist), on testing mode, the models are not loaded here (but in main_test())
+            self._restore_previous_model(self.sess)
+            if self.model_ready is not None:
+                self.sess.run(self.model_ready.assign(True))  # The other workers can start
+        else:  # The variables are shared through the parameter servers
+            self._wait_for_chief()
 
         if self.args.test:
             if self.args.test == Composer.TestMode.ALL:
                 self._main_test()
+            elif self.args.test == Composer.TestMode.EXPORT:
+                self._main_export()
             elif self.args.test == Composer.TestMode.DAEMON:
                 print('Daemon mode, running in background...')
                 raise NotImplementedError('No daemon mode')  # Come back later
@@ -201,91 +279,159 @@ class Composer:
         """
         assert self.sess
 
-        # Specific training dependent loading (Warning: When restoring a model, we don't restore the progression
-        # bar, nor the current batch.)
+        # Specific training dependent loading (When restoring a model, the samplers and the random generator restart
+        # from their saved state, so the training continue with the next batch)
+        for train_set, state in self.sampler_states.items():
+            self.music_data.get_sampler(train_set).set_state(state)
+        if self.random_state is not None:
+            np.random.set_state(self.random_state)
 
-        merged_summaries = tf.merge_all_summaries()
-        if self.glob_step == 0:  # Not restoring from previous run
+        if self.glob_step == 0 and self.is_chief:  # Not restoring from previous run
             self.writer.add_graph(self.sess.graph)  # First time only
 
         print('Start training (press Ctrl+C to save and exit)...')
 
         try:  # If the user exit while training, we still try to save the model
-            e = 0
-            while self.args.num_epochs == 0 or e < self.args.num_epochs:  # Main training loop (infinite if num_epoch==0)
-                e += 1
-
-                print()
-                print('------- Epoch {} (lr={}) -------'.format(
-                    '{}/{}'.format(e, self.args.num_epochs) if self.args.num_epochs else '{}'.format(e),
-                    self.model.learning_rate_policy.get_learning_rate(self.glob_step))
-                )
+            batches_test = self.music_data.iter_batches(train_set=False, nb_batches=0)  # Infinite (test set smaller than train set)
 
-                # Explicit garbage collector call (clear the previous batches)
-                gc.collect()  # TODO: Better memory management (use generators,...)
-
-                batches_train = self.music_data.get_batches(train_set=True)
-                batches_test = self.music_data.get_batches(train_set=False)
-
-                # Also update learning parameters eventually ?? (Some is done in the model class with the policy classes)
-
-                tic = datetime.datetime.now()
-                for next_batch in tqdm(batches_train, desc='Training'):  # Iterate over the batches
-                    # Indicate if the output should be computed or not
-                    is_output_visualized = self.glob_step % self.TRAINING_VISUALIZATION_STEP == 0
-
-                    # Training pass
-                    ops, feed_dict = self.model.step(
-                        next_batch,
-                        train_set=True,
-                        glob_step=self.glob_step,
-                        ret_output=is_output_visualized
-                    )
-                    outputs_train = self.sess.run((merged_summaries,) + ops, feed_dict)
-                    self.writer.add_summary(outputs_train[0], self.glob_step)
-
-                    # Testing pass (record the testing curve and visualize some testing predictions)
-                    # TODO: It makes no sense to completely disable the ground truth feeding (it's impossible to the
-                    # network to do a good prediction with only the first step)
-                    if is_output_visualized or (self.args.testing_curve and self.glob_step % self.args.testing_curve == 0):
-                        next_batch_test = batches_test[self.glob_step % len(batches_test)]  # Generate test batches in a cycling way (test set smaller than train set)
-                        ops, feed_dict = self.model.step(
-                            next_batch_test,
-                            train_set=False,
-                            ret_output=is_output_visualized
-                        )
-                        outputs_test = self.sess.run((merged_summaries,) + ops, feed_dict)
-                        self.writer_test.add_summary(outputs_test[0], self.glob_step)
-
-                    # Some visualisation (we compute some training/testing samples and compare them to the ground truth)
-                    if is_output_visualized:
-                        visualization_base_name = os.path.join(self.model_dir, self.TRAINING_VISUALIZATION_DIR, str(self.glob_step))
-                        tqdm.write('Visualizing: ' + visualization_base_name)
-                        self._visualize_output(
-                            visualization_base_name,
-                            outputs_train[-1],
-                            outputs_test[-1]  # The network output will always be the last operator returned by model.step()
-                        )
-
-                    # Checkpoint
-                    self.glob_step += 1  # Iterate here to avoid saving at the first iteration
-                    if self.glob_step % self.args.save_every == 0:
-                        self._save_session(self.sess)
-
-                toc = datetime.datetime.now()
-
-                print('Epoch finished in {}'.format(toc-tic))  # Warning: Will overflow if an epoch takes more than 24 hours, and the output isn't really nicer
+            if self.args.epochless:
+                self._train_epochless(batches_test)
+            else:
+                epoch_size = self.music_data.get_sampler(train_set=True).epoch_size
+                if not epoch_size:
+                    raise ValueError('Empty epoch: the training set is too small for a single batch (use --epochless to train anyway)')
+                while self.args.num_epochs == 0 or self.epoch < self.args.num_epochs:  # Main training loop (infinite if num_epoch==0)
+                    e = self.epoch + 1
+
+                    print()
+                    print('------- Epoch {} (lr={}){} -------'.format(
+                        '{}/{}'.format(e, self.args.num_epochs) if self.args.num_epochs else '{}'.format(e),
+                        self.model.learning_rate_policy.get_learning_rate(self.glob_step),
+                        ' resumed at batch {}'.format(self.epoch_step) if self.epoch_step else ''
+                    ))
+
+                    # The batches are streamed (created in background while training), only the remaining ones if the
+                    # epoch has been interrupted
+                    tic = datetime.datetime.now()
+                    wait_time = -batches_test.wait_time  # Only count the waiting time of this epoch
+                    if self.epoch_step < epoch_size:
+                        batches_train = self.music_data.iter_batches(train_set=True, nb_batches=epoch_size - self.epoch_step)
+
+                        # Also update learning parameters eventually ?? (Some is done in the model class with the policy classes)
+
+                        for next_batch in tqdm(batches_train, desc='Training', initial=self.epoch_step, total=epoch_size):  # Iterate over the batches
+                            self._train_step(next_batch, batches_test)
+                        wait_time += batches_train.wait_time
+                    toc = datetime.datetime.now()
+                    wait_time += batches_test.wait_time
+
+                    self.epoch += 1
+                    self.epoch_step = 0
+
+                    print('Epoch finished in {} ({} waiting for the batches)'.format(
+                        toc-tic,
+                        datetime.timedelta(seconds=wait_time))
+                    )  # Warning: Will overflow if an epoch takes more than 24 hours, and the output isn't really nicer
+            batches_test.close()
         except (KeyboardInterrupt, SystemExit):  # If the user press Ctrl+C while testing progress
             print('Interruption detected, exiting the program...')
 
-        self._save_session(self.sess)  # Ultimate saving before complete exit
+        if self.is_chief:
+            self._save_session(self.sess)  # Ultimate saving before complete exit
+            print('Writing the pending checkpoints...')
+            self.checkpointer.close()
+
+    def _train_epochless(self, batches_test):
+        """ Training loop without epochs
+        The extracts are drawn indefinitely, so the checkpoints and the learning rate only depend on the global step.
+        If num_epochs is set, the training stops after the equivalent number of steps.
+        Args:
+            batches_test (BatchPrefetcher): the infinite stream of testing batches
+        """
+        nb_steps = 0  # Infinite
+        if self.args.num_epochs:
+            nb_steps = self.args.num_epochs * self.music_data.get_sampler(train_set=True).epoch_size - self.glob_step
+            if nb_steps <= 0:
+                print('The model has already been trained for {} epochs'.format(self.args.num_epochs))
+                return
+
+        print()
+        print('------- Epoch-less training (lr={}) -------'.format(
+            self.model.learning_rate_policy.get_learning_rate(self.glob_step))
+        )
+
+        batches_train = self.music_data.iter_batches(train_set=True, nb_batches=nb_steps)
+        for next_batch in tqdm(batches_train, desc='Training', initial=self.glob_step, total=nb_steps + self.glob_step if nb_steps else None):
+            self._train_step(next_batch, batches_test)
+            if self.glob_step % self.args.save_every == 0:
+                tqdm.write('Step {}: lr={}, {} waiting for the batches'.format(
+                    self.glob_step,
+                    self.model.learning_rate_policy.get_learning_rate(self.glob_step),
+                    datetime.timedelta(seconds=batches_train.wait_time + batches_test.wait_time)
+                ))
+
+    def _train_step(self, next_batch, batches_test):
+        """ Train the model on one batch (and eventually record the testing curve and save a checkpoint)
+        Args:
+            next_batch (Batch): the training batch
+            batches_test (BatchPrefetcher): the infinite stream of testing batches
+        """
+        # Indicate if the output should be computed or not (the other workers only train)
+        is_output_visualized = self.is_chief and self.glob_step % self.TRAINING_VISUALIZATION_STEP == 0
+        is_test_recorded = self.is_chief and self.args.testing_curve and self.glob_step % self.args.testing_curve == 0
+
+        # Training pass
+        ops, feed_dict = self.model.step(
+            next_batch,
+            train_set=True,
+            glob_step=self.glob_step,
+            ret_output=is_output_visualized
+        )
+        outputs_train = self.sess.run(ops, feed_dict)  # The first operator is the summary
+        if self.is_chief:
+            self.writer.add_summary(outputs_train[0], self.glob_step)
+
+        # Testing pass (record the testing curve and visualize some testing predictions)
+        outputs_test = None
+        # TODO: It makes no sense to completely disable the ground truth feeding (it's impossible to the
+        # network to do a good prediction with only the first step)
+        if is_output_visualized or is_test_recorded:
+            next_batch_test = next(batches_test)
+            ops, feed_dict = self.model.step(
+                next_batch_test,
+                train_set=False,
+                ret_output=is_output_visualized
+            )
+            outputs_test = self.sess.run(ops, feed_dict)
+            self.writer_test.add_summary(outputs_test[0], self.glob_step)
+
+        # Some visualisation (we compute some training/testing samples and compare them to the ground truth)
+        if is_output_visualized:
+            visualization_base_name = os.path.join(self.model_dir, self.TRAINING_VISUALIZATION_DIR, str(self.glob_step))
+            tqdm.write('Visualizing: ' + visualization_base_name)
+            self._visualize_output(
+                visualization_base_name,
+                outputs_train[-1],
+                outputs_test[-1]  # The network output will always be the last operator returned by model.step()
+            )
+
+        # Keep track of the progression (to resume from here)
+        self.epoch_step += 1
+        self.sampler_states[True] = next_batch.sampler_state
+        if outputs_test is not None:
+            self.sampler_states[False] = next_batch_test.sampler_state
+        self.random_state = np.random.get_state()
+
+        # Checkpoint
+        self.glob_step += 1  # Iterate here to avoid saving at the first iteration (each worker counts its own steps)
+        if self.is_chief and self.glob_step % self.args.save_every == 0:
+            self._save_session(self.sess)
 
     def _main_test(self):
         """ Generate some songs
         The midi files will be saved on the same model_dir
         """
         assert self.sess
-        assert self.args.batch_size == 1
 
         print('Start predicting...')
 
@@ -294,21 +440,15 @@ class Composer:
             print('Warning: No model found in \'{}\'. Please train a model before trying to predict'.format(self.model_dir))
             return
 
-        batches, names = self.music_data.get_batches_test()
-        samples = list(zip(batches, names))
+        batch, names = self.music_data.get_batches_test()  # All initiators are generated at once
 
         # Predicting for each model present in modelDir
         for model_name in tqdm(sorted(model_list), desc='Model', unit='model'):  # TODO: Natural sorting / TODO: tqdm ?
             self.saver.restore(self.sess, model_name)
 
-            for next_sample in tqdm(samples, desc='Generating ({})'.format(os.path.basename(model_name)), unit='songs'):
-                batch = next_sample[0]
-                name = next_sample[1]  # Unzip
-
-                ops, feed_dict = self.model.step(batch)
-                assert len(ops) == 1  # output
-                outputs = self.sess.run(ops[0], feed_dict)
+            outputs = np.concatenate(list(self._generate_songs(batch)))  # [generate_length, nb_initiators, nb_keys]
 
+            for i, name in enumerate(names):
                 model_dir, model_filename = os.path.split(model_name)
                 model_dir = os.path.join(model_dir, self.TESTING_VISUALIZATION_DIR)
                 model_filename = model_filename[:-len(self.MODEL_EXT)] + '-' + name
@@ -316,7 +456,7 @@ class Composer:
                 # Save piano roll as image (color map red/blue to see the prediction confidence)
                 # Save the midi file
                 self.music_data.visit_recorder(
-                    outputs,
+                    outputs[:, i:i+1],  # The song of this initiator only
                     model_dir,
                     model_filename,
                     [ImgConnector, MidiConnector]
@@ -329,7 +469,80 @@ class Composer:
                 # tensor [NB_NOTES, nb_of_time_the_note_is played], could plot histogram normalized by nb of
                 # notes). Is piano roll enough ?
 
-        print('Prediction finished, {} songs generated'.format(self.args.batch_size * len(model_list) * len(batches)))
+        print('Prediction finished, {} songs generated'.format(len(model_list) * len(names)))
+
+    def _main_export(self):
+        """ Export the weights of all models, to generate songs without TensorFlow (see NumpyModel)
+        The exported files are saved next to the checkpoints. For each model, the numpy generation is compared with the
+        TensorFlow one on the initiators.
+        """
+        assert self.sess
+
+        print('Start exporting...')
+
+        model_list = self._get_model_list()
+        if not model_list:
+            print('Warning: No model found in \'{}\'. Please train a model before trying to export'.format(self.model_dir))
+            return
+
+        batch, _ = self.music_data.get_batches_test()
+        generate_length = self.args.generate_length or self.args.sample_length
+
+        for model_name in tqdm(sorted(model_list), desc='Model', unit='model'):
+            reader = tf.train.NewCheckpointReader(model_name)
+            variables = {name: reader.get_tensor(name) for name in reader.get_variable_to_shape_map()}
+            export_name = model_name[:-len(self.MODEL_EXT)] + self.EXPORT_EXT
+            NumpyModel.export(variables, export_name, self.args.note_range, self.args.sample_length)
+
+            # Check the exported network
+            self.saver.restore(self.sess, model_name)
+            outputs = np.concatenate(list(self._generate_songs(batch)))
+            numpy_outputs = NumpyModel(export_name).generate(batch.inputs, batch.initiator_lengths, generate_length)
+            error = np.max(np.abs(outputs - numpy_outputs))
+            tqdm.write('{}: max difference with TensorFlow {:.2e}'.format(os.path.basename(export_name), error))
+            if error > 1e-3:  # Float precision only
+                tqdm.write('Warning: the numpy generation does not match the TensorFlow one')
+
+        print('Export finished, {} models exported'.format(len(model_list)))
+
+    def _generate_songs(self, batch):
+        """ Generate the songs chunk by chunk
+        The graph only contains sample_length steps, so longer songs are produced by successive runs: each chunk
+        starts from the final state of the previous one and its first input is the last prediction (as inside the
+        graph). The initiators longer than a chunk are continued on the next ones.
+        Args:
+            batch (Batch): the initiators (see MusicData.get_batches_test)
+        Return:
+            Iterator[np.array]: the outputs of each chunk [nb_steps, nb_initiators, nb_keys] (the last chunk is cropped
+                to generate_length)
+        """
+        generate_length = self.args.generate_length or self.args.sample_length
+        initiators = np.asarray(batch.inputs)  # [nb_given, nb_initiators, nb_keys]
+        nb_given = batch.initiator_lengths
+        if nb_given is None:
+            nb_given = np.full(initiators.shape[1], len(initiators))
+
+        state = None
+        last_output = None
+        for start in range(0, generate_length, self.args.sample_length):
+            chunk = Batch()
+            chunk.inputs = -np.ones([self.args.sample_length] + list(initiators.shape[1:]), dtype=np.float32)
+            given = initiators[start:start+self.args.sample_length]
+            chunk.inputs[:len(given)] = given
+            chunk.initiator_lengths = np.clip(nb_given - start, 0, None)
+            if last_output is not None:  # The sequences without given input continue from their last prediction
+                continued = chunk.initiator_lengths == 0
+                chunk.inputs[0, continued] = 2.0 / (1.0 + np.exp(-last_output[continued])) - 1.0  # x = 2*sigmoid(y) - 1
+                chunk.initiator_lengths = np.maximum(chunk.initiator_lengths, 1)  # The first step is always given
+            chunk.initial_state = state
+
+            ops, feed_dict = self.model.step(chunk)
+            assert len(ops) == 2  # outputs, final state
+            outputs, state = self.sess.run(ops, feed_dict)
+            outputs = np.asarray(outputs)  # [sample_length, nb_initiators, nb_keys]
+            last_output = outputs[-1]
+
+            yield outputs[:generate_length - start]
 
     def _visualize_output(self, visualization_base_name, outputs_train, outputs_test):
         """ Record some result/generated songs during training.
@@ -372,7 +585,7 @@ class Composer:
             sess: The current running session
         """
 
-        if self.args.test == Composer.TestMode.ALL:  # On testing, the models are not restored here
+        if self.args.test in [Composer.TestMode.ALL, Composer.TestMode.EXPORT]:  # On testing, the models are not restored here
             return
 
         print('WARNING: ', end='')
@@ -386,6 +599,7 @@ class Composer:
             elif os.path.exists(model_name):  # Restore the model
                 print('Restoring previous model from {}'.format(model_name))
                 self.saver.restore(sess, model_name)  # Will crash when --reset is not activated and the model has not been saved yet
+                self._restore_training_state(model_name)
                 print('Model restored.')
             elif self._get_model_list():
                 print('Conflict with previous models.')
@@ -399,6 +613,8 @@ class Composer:
                 for root, dirs, files in os.walk(self.model_dir, topdown=False):
                     for name in files:
                         file_path = os.path.join(root, name)
+                        if file_path == os.path.join(self.model_dir, ExecutionProfile.FILENAME):  # Depends on the machine, not the model
+                            continue
                         print('Removing {}'.format(file_path))
                         os.remove(file_path)
         else:
@@ -406,20 +622,71 @@ class Composer:
 
     def _save_session(self, sess):
         """ Save the model parameters and the variables
+        The variables are copied in memory and written in background (see Checkpointer), the params and training
+        state of this step are written once the checkpoint is complete
         Args:
             sess: the current session
         """
-        tqdm.write('Checkpoint reached: saving model (don\'t stop the run)...')
-        self._save_params()
-        self.saver.save(sess, self._get_model_name())  # Put a limit size (ex: 3GB for the model_dir) ?
-        tqdm.write('Model saved.')
+        tqdm.write('Checkpoint reached: saving model...')
+        model_name = self._get_model_name()
+        config = self._get_params()  # The values have to be read now (the training continues during the save)
+        training_state = self._get_training_state()
+
+        def write_metadata():
+            self._save_training_state(model_name, training_state)
+            self._save_params(config)  # Last, so the restored glob_step never refers to an incomplete model
+            self._prune_models()
+            tqdm.write('Model saved: {}'.format(model_name))
+
+        self.checkpointer.save(sess, model_name, write_metadata)  # Put a limit size (ex: 3GB for the model_dir) ?
+
+    def _get_training_state(self):
+        """ Return the training progression (epoch, position of the samplers and random state)
+        Warning: if you modify this function, make sure the changes mirror _restore_training_state
+        Return:
+            dict: the values to save with the model
+        """
+        return {
+            'epoch': self.epoch,
+            'epoch_step': self.epoch_step,
+            'sampler_states': dict(self.sampler_states),  # Copy (modified by the next steps)
+            'random_state': self.random_state,
+        }
+
+    def _save_training_state(self, model_name, training_state):
+        """ Save the training progression next to the model
+        Args:
+            model_name (str): the path of the saved model
+            training_state (dict): the progression returned by _get_training_state
+        """
+        state_name = model_name + self.TRAINING_STATE_EXT
+        with open(state_name + '.tmp', 'wb') as handle:
+            pickle.dump(training_state, handle, -1)  # Using the highest protocol available
+        os.replace(state_name + '.tmp', state_name)  # Atomic, so an interruption never leave a corrupted file
+
+    def _restore_training_state(self, model_name):
+        """ Restore the training progression saved with the model, if any
+        Args:
+            model_name (str): the path of the restored model
+        """
+        state_name = model_name + self.TRAINING_STATE_EXT
+        if not os.path.exists(state_name):  # Model saved by a previous version
+            print('No training state found: the training will restart at the beginning of an epoch')
+            return
+        with open(state_name, 'rb') as handle:
+            training_state = pickle.load(handle)
+        self.epoch = training_state['epoch']
+        self.epoch_step = training_state['epoch_step']
+        self.sampler_states = training_state['sampler_states']
+        self.random_state = training_state['random_state']
+        print('Training state restored (epoch {}, batch {})'.format(self.epoch + 1, self.epoch_step))
 
     def _restore_params(self):
         """ Load the some values associated with the current model, like the current glob_step value.
         Needs to be called before any other function because it initialize some variables used on the rest of the
         program
 
-        Warning: if you modify this function, make sure the changes mirror _save_params, also check if the parameters
+        Warning: if you modify this function, make sure the changes mirror _get_params, also check if the parameters
         should be reset in manage_previous_model
         """
         # Compute the current model path
@@ -427,6 +694,8 @@ class Composer:
         if self.args.model_tag:
             self.model_dir += '-' + self.args.model_tag
 
+        self.args.note_range = None  # Defined by the dataset for a new model
+
         # If there is a previous model, restore some parameters
         config_name = os.path.join(self.model_dir, self.CONFIG_FILENAME)
         if not self.args.reset and not self.args.create_dataset and os.path.exists(config_name):
@@ -445,6 +714,8 @@ class Composer:
             self.args.dataset_tag = config['General'].get('dataset_tag')
             if not self.args.test:  # When testing, we don't use the training length
                 self.args.sample_length = config['General'].getint('sample_length')
+            note_range = config['General'].get('note_range', ' '.join(str(n) for n in music.MIDI_NOTES_RANGE))  # Models before keyboard cropping use all keys
+            self.args.note_range = [int(n) for n in note_range.split(' ')]
 
             self.args.enco = config['Network'].get('enco')
             self.args.deco = config['Network'].get('deco')
@@ -462,14 +733,15 @@ class Composer:
             # Show the restored params
             print('Warning: Restoring parameters from previous configuration (you should manually edit the file if you want to change one of those)')
 
-        # When testing, only predict one song at the time
+        # When testing, the songs are fully generated (the batch size is given by the nb of initiators)
         if self.args.test:
-            self.args.batch_size = 1
             self.args.scheduled_sampling = [Model.ScheduledSamplingPolicy.NONE]
 
-    def _save_params(self):
-        """ Save the params of the model, like the current glob_step value
+    def _get_params(self):
+        """ Return the params of the model, like the current glob_step value
         Warning: if you modify this function, make sure the changes mirror load_params
+        Return:
+            configparser.ConfigParser: the params to save
         """
         config = configparser.ConfigParser()
         config['General'] = {}
@@ -478,6 +750,7 @@ class Composer:
         config['General']['keep_all'] = str(self.args.keep_all)
         config['General']['dataset_tag'] = self.args.dataset_tag
         config['General']['sample_length'] = str(self.args.sample_length)
+        config['General']['note_range'] = ' '.join(str(n) for n in self.args.note_range)
 
         config['Network'] = {}
         config['Network']['enco'] = self.args.enco
@@ -494,9 +767,17 @@ class Composer:
         config['Training']['save_every'] = str(self.args.save_every)
         config['Training']['ratio_dataset'] = str(self.args.ratio_dataset)
         config['Training']['testing_curve'] = str(self.args.testing_curve)
+        return config
 
-        with open(os.path.join(self.model_dir, self.CONFIG_FILENAME), 'w') as config_file:
+    def _save_params(self, config):
+        """ Save the params of the model
+        Args:
+            config (configparser.ConfigParser): the params returned by _get_params
+        """
+        config_name = os.path.join(self.model_dir, self.CONFIG_FILENAME)
+        with open(config_name + '.tmp', 'w') as config_file:
             config.write(config_file)
+        os.replace(config_name + '.tmp', config_name)  # Atomic, as the checkpoint
 
     def _print_params(self):
         """ Print the current params
@@ -516,6 +797,8 @@ class Composer:
 
         print('learning_rate: {}'.format(' '.join(self.args.learning_rate)))
         print('batch_size: {}'.format(self.args.batch_size))
+        print('buckets: {}'.format(' '.join(str(b) for b in self.args.buckets)))
+        print('num_towers: {}'.format(self.args.num_towers))
         print('save_every: {}'.format(self.args.save_every))
         print('ratio_dataset: {}'.format(self.args.ratio_dataset))
         print('testing_curve: {}'.format(self.args.testing_curve))
@@ -532,22 +815,164 @@ class Composer:
             model_name += '-' + str(self.glob_step)
         return model_name + self.MODEL_EXT
 
+    def _prune_models(self):
+        """ Delete the oldest models (and their training states) when more than MAX_TO_KEEP are present
+        Only the keep_all mode is concerned (otherwise, the same model is overwritten at each checkpoint)
+        """
+        if not self.args.keep_all:
+            return
+        prefix = os.path.join(self.model_dir, self.MODEL_NAME_BASE + '-')
+        steps = {}  # Model name by glob_step
+        for model_name in self._get_model_list():
+            step = model_name[len(prefix):-len(self.MODEL_EXT)]
+            if model_name.startswith(prefix) and step.isdigit():
+                steps[int(step)] = model_name
+        for step in sorted(steps)[:-self.MAX_TO_KEEP]:
+            tqdm.write('Removing old model {}'.format(steps[step]))
+            for filename in [steps[step], steps[step] + self.TRAINING_STATE_EXT]:
+                if os.path.exists(filename):
+                    os.remove(filename)
+
     def _get_model_list(self):
         """ Return the list of the model files inside the model directory
         """
         return [os.path.join(self.model_dir, f) for f in os.listdir(self.model_dir) if f.endswith(self.MODEL_EXT)]
 
+    def _start_server(self):
+        """ Start the TensorFlow server of this process, for the distributed training
+        """
+        if not self.args.ps_hosts or not self.args.worker_hosts:
+            raise ValueError('The hosts of the parameter servers and workers have to be given (--ps_hosts, --worker_hosts)')
+        if self.args.test:
+            raise ValueError('The distributed mode is only used for training')
+
+        self.cluster = tf.train.ClusterSpec({'ps': self.args.ps_hosts, 'worker': self.args.worker_hosts})
+        self.server = tf.train.Server(self.cluster, job_name=self.args.job_name, task_index=self.args.task_index)
+        self.is_chief = self.args.job_name == 'worker' and self.args.task_index == 0
+
+    def _wait_for_chief(self):
+        """ Block until all variables have been initialized and restored by the chief worker
+        The variables are initialized before the restoration, so the workers also wait for the model_ready flag (set
+        after _restore_previous_model), otherwise their first updates would be overwritten by the restored values
+        """
+        print('Waiting for the chief worker to initialize the model...')
+        uninitialized_variables = tf.report_uninitialized_variables()
+        while len(self.sess.run(uninitialized_variables)) or not self.sess.run(self.model_ready):
+            time.sleep(1)
+
+    def _tune_session(self):
+        """ Benchmark the training step under a grid of thread pools settings and batch sizes
+        The fastest thread settings for the model batch size are saved next to the params (see ExecutionProfile) and
+        applied to all the next sessions of the model (training and generation). The throughput of the other batch
+        sizes is only reported.
+        """
+        if self.args.test:
+            raise ValueError('The session tuning uses the training set (not available when testing)')
+
+        batch_sizes = sorted(set((self.args.tune_batch_sizes or []) + [self.args.batch_size]))
+        batch_sizes = [b for b in batch_sizes if b % self.args.num_towers == 0]
+        thread_choices = ExecutionProfile.get_thread_choices()
+        print('Tuning the session (batch sizes: {}, threads: {})...'.format(batch_sizes, thread_choices))
+
+        # Real training batches (of the longest bucket), merged to obtain each tested batch size
+        length = self.args.buckets[-1]
+        parts = []
+        max_draws = 100 * len(self.args.buckets) * -(-batch_sizes[-1] // self.args.batch_size)  # The buckets are drawn uniformly
+        batches_train = self.music_data.iter_batches(train_set=True, nb_batches=max_draws)
+        for batch in batches_train:
+            if len(batch.inputs) == length:
+                parts.append(batch)
+                if sum(len(b.inputs[0]) for b in parts) >= batch_sizes[-1]:
+                    break
+        else:
+            raise RuntimeError('Not enough batches of the longest bucket ({} steps) drawn in {} batches: check --buckets'.format(length, max_draws))
+        batches_train.close()
+
+        def merge_batches(batch_size):
+            batch = Batch()
+            batch.inputs = np.concatenate([b.inputs for b in parts], axis=1)[:, :batch_size]
+            batch.targets = np.concatenate([b.targets for b in parts], axis=1)[:, :batch_size]
+            if parts[0].resets is not None:  # Packed songs
+                batch.resets = np.concatenate([b.resets for b in parts], axis=1)[:, :batch_size]
+                batch.weights = np.concatenate([b.weights for b in parts], axis=1)[:, :batch_size]
+            return batch
+        batches = {batch_size: merge_batches(batch_size) for batch_size in batch_sizes}
+
+        # The graph is built once (the batch size is dynamic), a new session is created for each thread settings
+        graph = tf.Graph()
+        with graph.as_default(), tf.device(self._get_device()):
+            model = Model(self.args)
+            init_op = tf.initialize_all_variables()
+
+        results = {}  # Samples/sec of each (intra_op_threads, inter_op_threads, batch_size)
+        for intra_op_threads in thread_choices:
+            for inter_op_threads in thread_choices:
+                profile = ExecutionProfile(intra_op_threads, inter_op_threads)
+                with tf.Session(graph=graph, config=self._get_session_config(profile)) as sess:
+                    sess.run(init_op)
+                    for batch_size in batch_sizes:
+                        ops, feed_dict = model.step(batches[batch_size], train_set=True, glob_step=0)
+                        sess.run(ops, feed_dict)  # Warm-up
+                        tic = time.perf_counter()
+                        for _ in range(self.TUNING_STEPS):
+                            sess.run(ops, feed_dict)
+                        results[intra_op_threads, inter_op_threads, batch_size] = batch_size * self.TUNING_STEPS / (time.perf_counter() - tic)
+                        print('{}, batch_size={}: {:.1f} samples/sec'.format(profile, batch_size, results[intra_op_threads, inter_op_threads, batch_size]))
+
+        best_threads = max(
+            [(intra, inter) for intra in thread_choices for inter in thread_choices],
+            key=lambda threads: results[threads + (self.args.batch_size,)]
+        )
+        best_batch_size = max(batch_sizes, key=lambda b: max(v for k, v in results.items() if k[2] == b))
+        profile = ExecutionProfile(*best_threads, batch_size=best_batch_size, samples_per_sec=results[best_threads + (self.args.batch_size,)])
+        profile.save(self.model_dir)
+
+        print('Best configuration: {} ({:.1f} samples/sec), saved in {}'.format(
+            profile,
+            profile.samples_per_sec,
+            os.path.join(self.model_dir, ExecutionProfile.FILENAME)
+        ))
+        if best_batch_size != self.args.batch_size:
+            print('Note: the best throughput is obtained with --batch_size {}'.format(best_batch_size))
+
+    def _get_session_config(self, profile=None):
+        """ Parse the arguments to configure the session
+        Args:
+            profile (ExecutionProfile): the thread settings (the saved profile of the model by default)
+        Return:
+            tf.ConfigProto: the session configuration
+        """
+        config = tf.ConfigProto()
+        if not self.args.test and self.args.num_towers > 1 and self.args.device != 'gpu':
+            config.device_count['CPU'] = self.args.num_towers  # One device by tower (see Model._get_tower_device)
+
+        if profile is None:
+            profile = ExecutionProfile.load(self.model_dir)
+            if profile is not None:
+                print('Execution profile: {}'.format(profile))
+        if profile is not None:
+            profile.apply(config)
+        return config
+
     def _get_device(self):
         """ Parse the argument to decide on which device run the model
         Return:
-            str: The name of the device on which run the program
+            Union[str, fct]: The name of the device on which run the program (or the function placing the variables on
+                the parameter servers for the distributed training)
         """
         if self.args.device == 'cpu':
-            return '"/cpu:0'
+            device = '/cpu:0'
         elif self.args.device == 'gpu':
-            return '/gpu:0'
+            device = '/gpu:0'
         elif self.args.device is None:  # No specified device (default)
-            return None
+            device = None
         else:
             print('Warning: Error in the device name: {}, use the default device'.format(self.args.device))
-            return None
+            device = None
+
+        if self.cluster:  # Distributed training: the variables are placed on the parameter servers
+            return tf.train.replica_device_setter(
+                worker_device='/job:worker/task:{}{}'.format(self.args.task_index, device or ''),
+                cluster=self.cluster
+            )
+        return device
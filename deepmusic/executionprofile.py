@@ -0,0 +1,108 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Thread pools configuration of the TensorFlow sessions
+
+"""
+
+import configparser
+import os
+
+
+class ExecutionProfile:
+    """ Execution settings tuned for the machine (see Composer._tune_session)
+    The profile is saved in the model directory (next to the params) and applied to each session created for this
+    model, training or generation.
+    """
+    FILENAME = 'execution.ini'
+
+    def __init__(self, intra_op_threads=0, inter_op_threads=0, batch_size=None, samples_per_sec=None):
+        """
+        Args:
+            intra_op_threads (int): nb of threads used inside an operator (ex: matrix product), 0 for TensorFlow choice
+            inter_op_threads (int): nb of operators run in parallel, 0 for TensorFlow choice
+            batch_size (int): the batch size with the best throughput (only a suggestion, not applied)
+            samples_per_sec (float): the measured throughput of the chosen configuration
+        """
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.batch_size = batch_size
+        self.samples_per_sec = samples_per_sec
+
+    @staticmethod
+    def get_thread_choices(nb_cores=None):
+        """ Return the tested thread pools sizes: powers of 2 up to the nb of cores (and the nb of cores itself)
+        Args:
+            nb_cores (int): nb of cores of the machine (detected if None)
+        Return:
+            List[int]: the sizes to test
+        """
+        nb_cores = nb_cores or os.cpu_count() or 1
+        choices = []
+        nb_threads = 1
+        while nb_threads < nb_cores:
+            choices.append(nb_threads)
+            nb_threads *= 2
+        choices.append(nb_cores)
+        return choices
+
+    @staticmethod
+    def load(model_dir):
+        """ Restore the profile of the model
+        Args:
+            model_dir (str): the model directory
+        Return:
+            ExecutionProfile: the saved profile, or None if the model has not been tuned
+        """
+        filename = os.path.join(model_dir, ExecutionProfile.FILENAME)
+        if not os.path.exists(filename):
+            return None
+        config = configparser.ConfigParser()
+        config.read(filename)
+        return ExecutionProfile(
+            intra_op_threads=config['Session'].getint('intra_op_threads'),
+            inter_op_threads=config['Session'].getint('inter_op_threads'),
+            batch_size=config['Benchmark'].getint('batch_size'),
+            samples_per_sec=config['Benchmark'].getfloat('samples_per_sec'),
+        )
+
+    def save(self, model_dir):
+        """ Save the profile in the model directory
+        Args:
+            model_dir (str): the model directory
+        """
+        config = configparser.ConfigParser()
+        config['Session'] = {}
+        config['Session']['intra_op_threads'] = str(self.intra_op_threads)
+        config['Session']['inter_op_threads'] = str(self.inter_op_threads)
+        config['Benchmark'] = {}  # For information
+        config['Benchmark']['batch_size'] = str(self.batch_size)
+        config['Benchmark']['samples_per_sec'] = str(self.samples_per_sec)
+
+        os.makedirs(model_dir, exist_ok=True)
+        with open(os.path.join(model_dir, ExecutionProfile.FILENAME), 'w') as config_file:
+            config.write(config_file)
+
+    def apply(self, config):
+        """ Set the thread pools of a session configuration
+        Args:
+            config (tf.ConfigProto): the configuration to modify
+        """
+        config.intra_op_parallelism_threads = self.intra_op_threads
+        config.inter_op_parallelism_threads = self.inter_op_threads
+
+    def __str__(self):
+        return '{} intra-op threads, {} inter-op threads'.format(self.intra_op_threads, self.inter_op_threads)
@@ -17,6 +17,9 @@
 Mid-level interface for the python files
 """
 
+import collections
+import struct
+import numpy as np
 import mido  # Midi lib
 
 import deepmusic.songstruct as music
@@ -26,6 +29,10 @@ class MidiInvalidException(Exception):
     pass
 
 
+# Program change message, as expected by Track.set_instrument() (avoid creating a mido message)
+_ProgramChange = collections.namedtuple('_ProgramChange', ['type', 'channel', 'program'])
+
+
 class MidiConnector:
     """ Class which manage the midi files at the message level
     """
@@ -44,6 +51,26 @@ class MidiConnector:
         'time_signature'
     ]
 
+    META_TYPES_NAMES = {  # Type byte of the meta messages, with their mido names (used by the fast parser)
+        0x00: 'sequence_number',
+        0x01: 'text',
+        0x02: 'copyright',
+        0x03: 'track_name',
+        0x04: 'instrument_name',
+        0x05: 'lyrics',
+        0x06: 'marker',
+        0x07: 'cue_marker',
+        0x09: 'device_name',
+        0x20: 'channel_prefix',
+        0x21: 'midi_port',
+        0x2f: 'end_of_track',
+        0x51: 'set_tempo',
+        0x54: 'smpte_offset',
+        0x58: 'time_signature',
+        0x59: 'key_signature',
+        0x7f: 'sequencer_specific'
+    }
+
     MINIMUM_TRACK_LENGTH = 4  # Bellow this value, the track will be ignored
 
     MIDI_CHANNEL_DRUMS = 10  # The channel reserved for the drums (according to the specs)
@@ -56,13 +83,17 @@ class MidiConnector:
     #self.data = None  # Sparse tensor of size [NB_KEYS,nb_bars*BAR_DIVISION] or simply a list of note ?
 
     @staticmethod
-    def load_file(filename):
+    def load_file(filename, fast=False):
         """ Extract data from midi file
         Args:
             filename (str): a valid midi file
+            fast (bool): if True, use the fast parser instead of mido (see _load_file_fast)
         Return:
             Song: a song object containing the tracks and melody
         """
+        if fast:
+            return MidiConnector._load_file_fast(filename)
+
         # Load in the MIDI data using the midi module
         midi_data = mido.MidiFile(filename)
 
@@ -201,6 +232,231 @@ class MidiConnector:
 
         return new_song
 
+    @staticmethod
+    def _load_file_fast(filename):
+        """ Extract data from midi file, by directly decoding the midi chunks
+        Contrary to load_file, no python object is created for each message: the notes of each track are decoded
+        into numpy arrays. The same rules are applied and the same MidiInvalidException are raised as with the mido
+        version (which is kept as reference). Malformed files also raise a MidiInvalidException.
+        Args:
+            filename (str): a valid midi file
+        Return:
+            Song: a song object containing the tracks and melody
+        """
+        with open(filename, 'rb') as midi_file:
+            data = midi_file.read()
+
+        try:
+            # Header chunk
+            if data[:4] != b'MThd':
+                raise MidiInvalidException('No midi header found')
+            header_size, midi_type, nb_tracks, ticks_per_beat = struct.unpack('>IHHH', data[4:14])
+
+            # Assert (see load_file for the details)
+            if midi_type != 1:
+                raise MidiInvalidException('Only type 1 supported ({} given)'.format(midi_type))
+            if not 0 < ticks_per_beat < 128:
+                raise MidiInvalidException('SMTPE timecode not supported ({} given)'.format(ticks_per_beat))
+
+            new_song = music.Song()
+            new_song.ticks_per_beat = ticks_per_beat
+
+            pos = 8 + header_size
+            for i in range(nb_tracks):
+                if data[pos:pos+4] != b'MTrk':
+                    raise MidiInvalidException('No header found for track {}'.format(i))
+                track_size = struct.unpack('>I', data[pos+4:pos+8])[0]
+                pos += 8
+                if pos + track_size > len(data):
+                    raise MidiInvalidException('Track {} truncated'.format(i))
+
+                if i == 0:  # Tempo map
+                    MidiConnector._read_tempo_map(data, pos, pos + track_size, new_song)
+                else:
+                    new_track, ticks, notes, durations = MidiConnector._read_track(data, pos, pos + track_size, i)
+
+                    # Assert
+                    if len(ticks) < MidiConnector.MINIMUM_TRACK_LENGTH:
+                        pass
+                    elif new_track.is_drum:
+                        pass
+                    else:
+                        new_track.add_notes(ticks, notes, durations)
+                        new_song.tracks.append(new_track)
+                pos += track_size
+        except (IndexError, struct.error):  # Reading outside the data
+            raise MidiInvalidException('Midi file truncated')
+
+        if not new_song.tracks:
+            raise MidiInvalidException('Empty song. No track added')
+
+        return new_song
+
+    @staticmethod
+    def _read_variable_int(data, pos):
+        """ Decode a variable length quantity
+        Args:
+            data (bytes): the midi file content
+            pos (int): position of the first byte
+        Return:
+            Tuple[int, int]: the value and the position of the next byte
+        """
+        value = 0
+        while True:
+            byte = data[pos]
+            pos += 1
+            value = (value << 7) | (byte & 0x7f)
+            if byte < 0x80:
+                return value, pos
+
+    @staticmethod
+    def _read_meta(data, pos):
+        """ Decode a meta message (the 0xff status byte already read)
+        Return:
+            Tuple[str, bytes, int]: the mido name of the message, its data and the position of the next event
+        """
+        meta_type = data[pos]
+        length, pos = MidiConnector._read_variable_int(data, pos + 1)
+        return MidiConnector.META_TYPES_NAMES.get(meta_type, 'unknown_meta'), data[pos:pos+length], pos + length
+
+    @staticmethod
+    def _read_tempo_map(data, pos, end, new_song):
+        """ Decode the first track of the song
+        Args:
+            data (bytes): the midi file content
+            pos (int): position of the first event of the track
+            end (int): end of the track
+            new_song (Song): the song to which add the tempo changes
+        """
+        while pos < end:
+            delta, pos = MidiConnector._read_variable_int(data, pos)
+            status = data[pos]
+            if status != 0xff:
+                raise MidiInvalidException('Tempo map should not contains notes')
+            meta_type, meta_data, pos = MidiConnector._read_meta(data, pos + 1)
+
+            if meta_type in MidiConnector.META_INFO_TYPES:
+                pass
+            elif meta_type == 'set_tempo':
+                new_song.tempo_map.append(mido.MetaMessage('set_tempo', tempo=int.from_bytes(meta_data, 'big'), time=delta))
+            elif meta_type in MidiConnector.META_TEMPO_TYPES:
+                pass
+            elif meta_type == 'smpte_offset':
+                pass  # TODO
+            else:
+                err_msg = 'Header track contains unsupported meta-message type ({})'.format(meta_type)
+                raise MidiInvalidException(err_msg)
+
+    @staticmethod
+    def _read_track(data, pos, end, i):
+        """ Decode the notes of a track
+        Args:
+            data (bytes): the midi file content
+            pos (int): position of the first event of the track
+            end (int): end of the track
+            i (int): the track id (Warning: the tempo map is the track 0)
+        Return:
+            Tuple[Track, np.array, np.array, np.array]: the track (without the notes) and its notes as arrays of ticks,
+                notes and durations (in the order they have been released)
+        """
+        new_track = music.Track()
+        ticks = []
+        notes = []
+        durations = []
+
+        buffer_notes = []  # Store the current notes (pressed but not released) as [note, tick]
+        abs_tick = 0  # Absolute nb of ticks from the beginning of the track
+        last_status = None  # Running status
+        while pos < end:
+            delta, pos = MidiConnector._read_variable_int(data, pos)
+            abs_tick += delta
+
+            status = data[pos]
+            if status < 0x80:  # Running status (the first data byte is not consumed)
+                if last_status is None:
+                    raise MidiInvalidException('Running status without last status (track {})'.format(i))
+                status = last_status
+            else:
+                pos += 1
+                if status != 0xff:  # Meta messages don't set running status
+                    last_status = status
+
+            if status == 0xff:  # Lyrics, track name and other meta info
+                meta_type, _, pos = MidiConnector._read_meta(data, pos)
+                if meta_type in MidiConnector.META_INFO_TYPES:
+                    pass
+                elif meta_type in MidiConnector.META_TEMPO_TYPES:
+                    raise MidiInvalidException('Track {} should not contain {}'.format(i, meta_type))
+                else:
+                    err_msg = 'Track {} contains unsupported meta-message type ({})'.format(i, meta_type)
+                    raise MidiInvalidException(err_msg)
+                continue
+
+            if status in (0xf0, 0xf7):  # Sysex
+                raise MidiInvalidException('Track {} contains unsupported message type (sysex)'.format(i))
+
+            message_type = status & 0xf0
+            channel = status & 0x0f
+            if message_type in (0xc0, 0xd0):  # Single data byte messages
+                data_bytes = data[pos:pos+1]
+            elif message_type != 0xf0:
+                data_bytes = data[pos:pos+2]
+            else:  # System common and real time messages
+                message = MidiConnector._decode_message(data, pos, status, delta)
+                raise MidiInvalidException('Track {} contains unsupported message type ({})'.format(i, message))
+            pos += len(data_bytes)
+            if len(data_bytes) != (1 if message_type in (0xc0, 0xd0) else 2):
+                raise IndexError('Message truncated')
+            if any(byte > 127 for byte in data_bytes):
+                raise MidiInvalidException('Track {}: data byte must be in range 0..127'.format(i))
+
+            if message_type == 0x90 and data_bytes[1] != 0:  # Note added
+                if channel+1 != i and channel+1 != MidiConnector.MIDI_CHANNEL_DRUMS:  # TODO: Channel management for type 0
+                    raise MidiInvalidException('Notes belong to the wrong tracks ({} instead of {})'.format(i, channel))
+                buffer_notes.append([data_bytes[0], abs_tick])
+            elif message_type == 0x80 or message_type == 0x90:  # Note released
+                # Same behavior as the mido version (which removes the notes while iterating over the list, so the
+                # note following a released one is skipped)
+                j = 0
+                while j < len(buffer_notes):
+                    if buffer_notes[j][0] == data_bytes[0]:
+                        ticks.append(buffer_notes[j][1])
+                        notes.append(data_bytes[0])
+                        durations.append(abs_tick - buffer_notes[j][1])
+                        del buffer_notes[j]
+                    j += 1
+            elif message_type == 0xc0:  # Instrument change
+                if not new_track.set_instrument(_ProgramChange('program_change', channel, data_bytes[0])):
+                    # TODO: We should create another track with the new instrument
+                    raise MidiInvalidException('Track {} as already a program defined'.format(i))
+            elif message_type in (0xb0, 0xd0, 0xe0):  # Control change, aftertouch and pitchwheel are ignored
+                pass
+            else:
+                message = mido.Message.from_bytes([status] + list(data_bytes), time=delta)
+                raise MidiInvalidException('Track {} contains unsupported message type ({})'.format(i, message))
+
+        # Assert
+        if buffer_notes:  # All notes should have ended
+            raise MidiInvalidException('Some notes ({}) did not ended'.format(len(buffer_notes)))
+
+        return (
+            new_track,
+            np.array(ticks, dtype=np.int64),
+            np.array(notes, dtype=np.int64),
+            np.array(durations, dtype=np.int64)
+        )
+
+    @staticmethod
+    def _decode_message(data, pos, status, delta):
+        """ Decode a system message with mido (only used for the error messages)
+        """
+        for length in range(3):
+            try:
+                return mido.Message.from_bytes([status] + list(data[pos:pos+length]), time=delta)
+            except ValueError:
+                pass
+        return 'undefined status byte 0x{:02x}'.format(status)
+
     @staticmethod
     def write_song(song, filename):
         """ Save the song on disk
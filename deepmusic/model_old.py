@@ -22,7 +22,6 @@ import numpy as np  # To generate random numbers
 import tensorflow as tf
 
 from deepmusic.musicdata import Batch
-import deepmusic.songstruct as music
 
 
 class Model:
@@ -45,13 +44,33 @@ class Model:
             """
             self.args = args
 
-        def get_weight(self, i):
+        def get_weight(self, i, length=None):
             """ Return the target weight for the given step i using the chosen policy
+            Args:
+                i (int): the timestep
+                length (int): the length of the sequence (sample_length by default)
             """
+            length = length or self.args.sample_length
             if not self.args.target_weights or self.args.target_weights == Model.TargetWeightsPolicy.NONE:
                 return 1.0
             elif self.args.target_weights == Model.TargetWeightsPolicy.LINEAR:
-                return i / (self.args.sample_length - 1)  # Gradually increment the loss weight
+                return i / (length - 1)  # Gradually increment the loss weight
+            elif self.args.target_weights == Model.TargetWeightsPolicy.STEP:
+                raise NotImplementedError('Step target weight policy not implemented yet, please consider another policy')
+            else:
+                raise ValueError('Unknown chosen target weight policy: {}'.format(self.args.target_weights))
+
+        def get_weights(self, length):
+            """ Return the target weights of all steps of a sequence, as a tensor (same as get_weight)
+            Args:
+                length (tf.Tensor): the length of the sequence (only known when running the graph)
+            Return:
+                tf.Tensor: the weights of each step [length]
+            """
+            if not self.args.target_weights or self.args.target_weights == Model.TargetWeightsPolicy.NONE:
+                return tf.ones(tf.expand_dims(length, 0))
+            elif self.args.target_weights == Model.TargetWeightsPolicy.LINEAR:
+                return tf.to_float(tf.range(length)) / tf.to_float(length - 1)  # Gradually increment the loss weight
             elif self.args.target_weights == Model.TargetWeightsPolicy.STEP:
                 raise NotImplementedError('Step target weight policy not implemented yet, please consider another policy')
             else:
@@ -68,6 +87,22 @@ class Model:
                 Model.TargetWeightsPolicy.STEP
             ]
 
+    class GraphMode:
+        """ Structure to represent the different ways of building the graph
+        """
+        STATIC = 'static'  # One placeholder and one unrolled cell by time step (default behavior)
+        DYNAMIC = 'dynamic'  # Single [time, batch, notes] tensors and a while loop over the time steps
+
+        @staticmethod
+        def get_modes():
+            """ Return the list of the different modes
+            Useful when parsing the command lines arguments
+            """
+            return [
+                Model.GraphMode.STATIC,
+                Model.GraphMode.DYNAMIC
+            ]
+
     class ScheduledSamplingPolicy:
         """ Container for the schedule sampling policy
         See http://arxiv.org/abs/1506.03099 for more details
@@ -206,16 +241,28 @@ class Model:
 
         self.args = args  # Keep track of the parameters of the model
 
-        # Placeholders
+        # Placeholders (list of one placeholder by step, or single tensors with the dynamic graph)
         self.inputs = None
         self.targets = None
         self.use_prev = None  # Boolean tensor which say at Graph evaluation time if we use the input placeholder or the previous output.
+        self.resets = None  # Packed songs only: for each step, the sequences for which a new song starts
+        self.loss_weights = None  # Packed songs only: for each step, the sequences for which the target is penalized
         self.current_learning_rate = None  # Allow to have a dynamic learning rate
 
-        # Main operators
-        self.opt_op = None  # Optimizer
-        self.outputs = None  # Outputs of the network
-        self.final_state = None  # When testing, we feed this value as initial state ?
+        # Main operators (one for each sequence length)
+        self.lengths = [self.args.sample_length] if self.args.test else self.args.buckets  # The buckets (sorted)
+        self.opt_op = {}  # Optimizer
+        self.outputs = {}  # Outputs of the network
+        self.final_state = {}  # State after the last step (when generating, fed as initial state of the next chunk)
+        self.initial_state = None  # Zero state by default, can be fed to continue a previous sequence
+
+        # Single step operators (interactive generation, one time step by run)
+        self.single_input = None  # Previous keyboard
+        self.single_state = None  # State before the step (tuple of LSTMStateTuple placeholders)
+        self.single_output = None  # Prediction of the next keyboard (logits)
+        self.single_next_input = None  # Prediction converted as next input (2*sigmoid(y)-1)
+        self.single_final_state = None  # State after the step
+        self.loss_summary = {}  # Training loss
 
         # Other options
         self.target_weights_policy = None
@@ -223,132 +270,528 @@ class Model:
         self.learning_rate_policy = None
 
         # Construct the graphs
-        self._build_network()
+        if self.args.graph == Model.GraphMode.DYNAMIC:
+            self._build_dynamic_network()
+        else:
+            self._build_network()
 
     def _build_network(self):
         """ Create the computational graph
         """
 
-        # Placeholders (Use tf.SparseTensor with training=False instead) (TODO: Try restoring dynamic batch_size)
+        nb_keys = self.args.note_range[1] - self.args.note_range[0] + 1  # Keyboard width (all keys, or the ones used by the dataset)
+
+        # Placeholders (Use tf.SparseTensor with training=False instead). The batch size is only known when running
+        # the graph (when generating, all initiators are predicted at once)
         with tf.name_scope('placeholder_inputs'):
             self.inputs = [
                 tf.placeholder(
                     tf.float32,  # -1.0/1.0 ? Probably better for the sigmoid
-                    [self.args.batch_size, music.NB_NOTES],
+                    [None, nb_keys],
                     name='input')
-                for _ in range(self.args.sample_length)
+                for _ in range(self.lengths[-1])
                 ]
         with tf.name_scope('placeholder_targets'):
             self.targets = [
                 tf.placeholder(
                     tf.float32,  # 0/1
-                    [self.args.batch_size, music.NB_NOTES],
+                    [None, nb_keys],
                     name='target')
-                for _ in range(self.args.sample_length)
+                for _ in range(self.lengths[-1])
                 ]
         with tf.name_scope('placeholder_use_prev'):
             self.use_prev = [
                 tf.placeholder(
                     tf.bool,
-                    [],
+                    [None],  # For each sequence of the batch
                     name='use_prev')
-                for _ in range(self.args.sample_length)  # The first value will never be used (always takes self.input for the first step)
+                for _ in range(self.lengths[-1])  # The first value will never be used (always takes self.input for the first step)
                 ]
+        is_packed = not self.args.test and self.args.pack_songs  # Multiple songs by sequence
+        if is_packed:
+            with tf.name_scope('placeholder_resets'):
+                self.resets = [
+                    tf.placeholder(
+                        tf.bool,
+                        [None],
+                        name='reset')
+                    for _ in range(self.lengths[-1])
+                    ]
+            with tf.name_scope('placeholder_loss_weights'):
+                self.loss_weights = [
+                    tf.placeholder(
+                        tf.float32,  # 0/1
+                        [None],
+                        name='loss_weight')
+                    for _ in range(self.lengths[-1])
+                    ]
 
         # Projection on the keyboard
         with tf.name_scope('note_projection_weights'):
             W = tf.Variable(
-                tf.truncated_normal([self.args.hidden_size, music.NB_NOTES]),
+                tf.truncated_normal([self.args.hidden_size, nb_keys]),
                 name='weights'
             )
             b = tf.Variable(
-                tf.truncated_normal([music.NB_NOTES]),  # Tune the initializer ?
+                tf.truncated_normal([nb_keys]),  # Tune the initializer ?
                 name='bias',
             )
 
         def project_note(X):
             with tf.name_scope('note_projection'):
-                return tf.matmul(X, W) + b  # [batch_size, NB_NOTE]
+                return tf.matmul(X, W) + b  # [batch_size, nb_keys]
 
         # RNN network
         rnn_cell = tf.nn.rnn_cell.BasicLSTMCell(self.args.hidden_size, state_is_tuple=True)  # Or GRUCell, LSTMCell(args.hidden_size)
         #rnn_cell = tf.nn.rnn_cell.DropoutWrapper(rnn_cell, input_keep_prob=1.0, output_keep_prob=1.0)  # TODO: Custom values (WARNING: No dropout when testing !!!, possible to use placeholder ?)
         rnn_cell = tf.nn.rnn_cell.MultiRNNCell([rnn_cell] * self.args.num_layers, state_is_tuple=True)
 
-        initial_state = rnn_cell.zero_state(batch_size=self.args.batch_size, dtype=tf.float32)
-
-        def loop_rnn(prev, i):
-            """ Loop function used to connect one output of the rnn to the next input.
-            Will re-adapt the output shape to the input one.
-            This is useful to use the same network for both training and testing. Warning: Because of the fixed
-            batch size, we have to predict batch_size sequences when testing.
+        # Data parallelism: each tower computes a slice of the batch (training only)
+        nb_towers = 1 if self.args.test else self.args.num_towers
+        tower_inputs = self._split_towers(self.inputs, nb_towers)
+        tower_targets = self._split_towers(self.targets, nb_towers)
+        tower_use_prev = self._split_towers(self.use_prev, nb_towers)
+        tower_resets = self._split_towers(self.resets, nb_towers) if is_packed else [None] * nb_towers
+        tower_loss_weights = self._split_towers(self.loss_weights, nb_towers) if is_packed else [None] * nb_towers
+
+        initial_states = []
+        for inputs in tower_inputs:
+            initial_states.append(rnn_cell.zero_state(batch_size=tf.shape(inputs[0])[0], dtype=tf.float32))  # Runtime batch size
+        self.initial_state = initial_states[0]  # Generation (single tower)
+
+        def create_loop_rnn(inputs, use_prev, resets):
+            """ Return the loop function of the given inputs (one by tower)
             """
-            # Predict the output from prev and scale the result on [-1, 1]
-            next_input = project_note(prev)
-            next_input = tf.sub(tf.mul(2.0, tf.nn.sigmoid(next_input)), 1.0)  # x_{i} = 2*sigmoid(y_{i-1}) - 1
-
-            # On training, we force the correct input, on testing, we use the previous output as next input
-            return tf.cond(self.use_prev[i], lambda: next_input, lambda: self.inputs[i])
-
-        (outputs, self.final_state) = tf.nn.seq2seq.rnn_decoder(
-            decoder_inputs=self.inputs,
-            initial_state=initial_state,
-            cell=rnn_cell,
-            loop_function=loop_rnn
+            def loop_rnn(prev, i):
+                """ Loop function used to connect one output of the rnn to the next input.
+                Will re-adapt the output shape to the input one.
+                This is useful to use the same network for both training and testing.
+                """
+                # Predict the output from prev and scale the result on [-1, 1]
+                next_input = project_note(prev)
+                next_input = tf.sub(tf.mul(2.0, tf.nn.sigmoid(next_input)), 1.0)  # x_{i} = 2*sigmoid(y_{i-1}) - 1
+
+                # On training, we force the correct input, on testing, we use the previous output as next input (each
+                # sequence can switch at a different step)
+                next_input = tf.select(use_prev[i], next_input, inputs[i])
+                if is_packed:  # The previous output belongs to the previous song
+                    next_input = tf.select(resets[i], inputs[i], next_input)
+                return next_input
+            return loop_rnn
+
+        # For training only
+        if not self.args.test:
+            opt = self._create_optimizer()  # Shared by all buckets
+
+        # One unrolled graph by sequence length (bucket) and by tower, all sharing the same weights
+        for length in self.lengths:
+            tower_outputs = []
+            tower_final_states = []
+            tower_losses = []
+            for t in range(nb_towers):
+                inputs = tower_inputs[t]
+                loop_rnn = create_loop_rnn(inputs, tower_use_prev[t], tower_resets[t])
+                with tf.device(self._get_tower_device(t, nb_towers)):
+                    with tf.variable_scope(tf.get_variable_scope(), reuse=True if length != self.lengths[0] or t else None):
+                        if is_packed:
+                            (outputs, final_state) = self._packed_rnn_decoder(inputs[:length], initial_states[t], rnn_cell, loop_rnn, tower_resets[t])
+                        else:
+                            (outputs, final_state) = tf.nn.seq2seq.rnn_decoder(
+                                decoder_inputs=inputs[:length],
+                                initial_state=initial_states[t],
+                                cell=rnn_cell,
+                                loop_function=loop_rnn
+                            )
+
+                    # Final projection
+                    with tf.name_scope('final_output'):
+                        outputs = [project_note(output) for output in outputs]
+                    tower_outputs.append(outputs)
+                    tower_final_states.append(final_state)
+
+                    # For training only
+                    if not self.args.test:
+                        # Finally, we define the loss function
+
+                        # The network will predict a mix a wrong and right notes. For the loss function, we would like to
+                        # penalize note which are wrong. Eventually, the penalty should be less if the network predict the same
+                        # note but not in the right pitch (ex: C4 instead of C5), with a decay the further the prediction
+                        # is (D5 and D1 more penalized than D4 and D3 if the target is D2)
+
+                        # For now, by using sigmoid_cross_entropy_with_logits, the task is formulated as a NB_NOTES binary
+                        # classification problems
+
+                        weights = [tf.constant(self.target_weights_policy.get_weight(i, length)) for i in range(length)]  # Broadcasted over the batch
+                        if is_packed:  # No loss across the songs boundaries
+                            weights = [w * tf.expand_dims(m, 1) for w, m in zip(weights, tower_loss_weights[t])]
+                        loss_fct = tf.nn.seq2seq.sequence_loss(
+                            outputs,
+                            tower_targets[t][:length],
+                            weights,
+                            softmax_loss_function=tf.nn.sigmoid_cross_entropy_with_logits,
+                            average_across_timesteps=False,  # I think it's best for variables length sequences (specially with the target weights=0), isn't it (it implies also that short sequences are less penalized than long ones) ? (TODO: For variables length sequences, be careful about the target weights)
+                            average_across_batch=False  # Penalize by sample (should allows dynamic batch size) Warning: need to tune the learning rate
+                        )
+                        # Normalized by bucket: each step has the same contribution whatever the sequence length (the scale
+                        # stays the one of sample_length, so the learning rate does not need to be tuned again)
+                        tower_losses.append(loss_fct * (self.args.sample_length / length))
+
+            # Merge the towers
+            if nb_towers == 1:
+                self.outputs[length] = tower_outputs[0]
+                self.final_state[length] = tower_final_states[0]
+            else:
+                self.outputs[length] = [tf.concat(0, list(step_outputs)) for step_outputs in zip(*tower_outputs)]
+                self.final_state[length] = self._concat_states(tower_final_states)
+
+            # For training only
+            if not self.args.test:
+                loss_fct = tf.add_n(tower_losses)  # Sum over the batch
+                self.loss_summary[length] = tf.scalar_summary('training_loss', loss_fct, collections=[])  # Keep track of the cost (only the fed bucket can be evaluated)
+
+                # TODO: Also keep track of magnitudes (how much is updated)
+                self.opt_op[length] = self._minimize(opt, tower_losses)
+
+        self._build_single_step(rnn_cell, project_note, nb_keys)
+
+    def _split_towers(self, tensors, nb_towers, axis=0):
+        """ Split the batch between the towers
+        Args:
+            tensors (Union[tf.Tensor, List[tf.Tensor]]): a tensor or the list of the tensors of each step
+            nb_towers (int): the nb of slices (the batch size has to be a multiple)
+            axis (int): the batch dimension
+        Return:
+            list: the tensor (or list of tensors) of each tower
+        """
+        if nb_towers == 1:  # Keep the original graph
+            return [tensors]
+        if isinstance(tensors, list):
+            return [list(step_tensors) for step_tensors in zip(*[tf.split(axis, nb_towers, t) for t in tensors])]
+        return tf.split(axis, nb_towers, tensors)
+
+    def _get_tower_device(self, t, nb_towers):
+        """ Return the device of the given tower (one core or gpu by tower)
+        Args:
+            t (int): the tower index
+            nb_towers (int): the nb of towers
+        Return:
+            str: the device name (None for a single tower, so the device given by the caller is used)
+        """
+        if nb_towers == 1:
+            return None
+        return '/{}:{}'.format('gpu' if self.args.device == 'gpu' else 'cpu', t)
+
+    def _concat_states(self, tower_states, axis=0):
+        """ Merge the LSTM states of the towers
+        Args:
+            tower_states (List[Tuple[LSTMStateTuple]]): the state of each tower
+            axis (int): the batch dimension
+        Return:
+            Tuple[LSTMStateTuple]: the state of the whole batch
+        """
+        return tuple(
+            tf.nn.rnn_cell.LSTMStateTuple(
+                tf.concat(axis, [layer_state.c for layer_state in layer_states]),
+                tf.concat(axis, [layer_state.h for layer_state in layer_states]),
+            ) for layer_states in zip(*tower_states)
+        )
+
+    def _minimize(self, opt, tower_losses):
+        """ Create the training operator
+        With several towers, the gradients of each tower are computed on its device, then combined for a single
+        update. The losses being sums over the batch, the gradients are added: same update as with a single tower.
+        Args:
+            opt (tf.train.Optimizer): the optimizer
+            tower_losses (List[tf.Tensor]): the loss of each tower
+        Return:
+            tf.Operation: the training operator
+        """
+        if len(tower_losses) == 1:
+            return opt.minimize(tower_losses[0])
+
+        tower_grads = []
+        for t, loss_fct in enumerate(tower_losses):
+            with tf.device(self._get_tower_device(t, len(tower_losses))):
+                tower_grads.append(opt.compute_gradients(loss_fct))
+
+        grads_and_vars = []
+        for var_grads in zip(*tower_grads):  # Same variables order for all towers
+            grads = [g for g, _ in var_grads if g is not None]
+            grads_and_vars.append((tf.add_n(grads) if grads else None, var_grads[0][1]))
+        return opt.apply_gradients(grads_and_vars)
+
+    def _create_optimizer(self):
+        """ Load the training policies and create the optimizer
+        Return:
+            tf.train.Optimizer: the optimizer, using the learning rate placeholder
+        """
+        self.schedule_policy = Model.ScheduledSamplingPolicy(self.args)
+        self.target_weights_policy = Model.TargetWeightsPolicy(self.args)
+        self.learning_rate_policy = Model.LearningRatePolicy(self.args)  # Load the chosen policies
+
+        self.current_learning_rate = tf.placeholder(tf.float32, [])
+
+        # Initialize the optimizer
+        return tf.train.AdamOptimizer(
+            learning_rate=self.current_learning_rate,
+            beta1=0.9,
+            beta2=0.999,
+            epsilon=1e-08
         )
 
-        # Final projection
-        with tf.name_scope('final_output'):
-            self.outputs = []
-            for output in outputs:
-                proj = project_note(output)
-                self.outputs.append(proj)
+    def _build_dynamic_network(self):
+        """ Create the computational graph, with a while loop over the time steps
+        The sequences are fed as single [time, batch_size, nb_keys] tensors, so the graph size (and build time) does
+        not depend on the sequence length and the same graph is used for all buckets. The variables have the same
+        names as the unrolled graph, so the checkpoints can be used by both modes.
+        """
+        nb_keys = self.args.note_range[1] - self.args.note_range[0] + 1  # Keyboard width (all keys, or the ones used by the dataset)
+        is_packed = not self.args.test and self.args.pack_songs  # Multiple songs by sequence
+
+        # Placeholders (the first dimension is the time, the second the batch, only known when running the graph)
+        with tf.name_scope('placeholder_inputs'):
+            self.inputs = tf.placeholder(tf.float32, [None, None, nb_keys], name='input')  # -1.0/1.0
+        with tf.name_scope('placeholder_targets'):
+            self.targets = tf.placeholder(tf.float32, [None, None, nb_keys], name='target')  # 0/1
+        with tf.name_scope('placeholder_use_prev'):
+            self.use_prev = tf.placeholder(tf.bool, [None, None], name='use_prev')  # The first step will never be used
+        if is_packed:
+            with tf.name_scope('placeholder_resets'):
+                self.resets = tf.placeholder(tf.bool, [None, None], name='reset')
+            with tf.name_scope('placeholder_loss_weights'):
+                self.loss_weights = tf.placeholder(tf.float32, [None, None], name='loss_weight')  # 0/1
+
+        # Projection on the keyboard
+        with tf.name_scope('note_projection_weights'):
+            W = tf.Variable(
+                tf.truncated_normal([self.args.hidden_size, nb_keys]),
+                name='weights'
+            )
+            b = tf.Variable(
+                tf.truncated_normal([nb_keys]),  # Tune the initializer ?
+                name='bias',
+            )
+
+        def project_note(X):
+            with tf.name_scope('note_projection'):
+                return tf.matmul(X, W) + b  # [batch_size, nb_keys]
+
+        # RNN network
+        rnn_cell = tf.nn.rnn_cell.BasicLSTMCell(self.args.hidden_size, state_is_tuple=True)
+        rnn_cell = tf.nn.rnn_cell.MultiRNNCell([rnn_cell] * self.args.num_layers, state_is_tuple=True)
+
+        nb_steps = tf.shape(self.inputs)[0]
+
+        def build_tower(inputs, use_prev, resets):
+            """ Create the while loop over the given inputs [time, batch_size, nb_keys] (one by tower)
+            Return:
+                Tuple: the outputs [time, batch_size, nb_keys], the initial and final states
+            """
+            batch_size = tf.shape(inputs)[1]
+            initial_state = rnn_cell.zero_state(batch_size=batch_size, dtype=tf.float32)
+
+            inputs_ta = tf.TensorArray(tf.float32, size=nb_steps).unpack(inputs)
+            outputs_ta = tf.TensorArray(tf.float32, size=nb_steps)
+
+            def loop_rnn(i, prev_output, outputs_ta, *flat_state):
+                """ Compute one time step
+                The state is given flattened ((c, h) of each layer)
+                """
+                state = tuple(
+                    tf.nn.rnn_cell.LSTMStateTuple(flat_state[2*l], flat_state[2*l+1]) for l in range(self.args.num_layers)
+                )
+
+                # On training, we force the correct input, on testing, we use the previous output as next input
+                given_input = inputs_ta.read(i)
+                prev_input = tf.sub(tf.mul(2.0, tf.nn.sigmoid(project_note(prev_output))), 1.0)  # x_{i} = 2*sigmoid(y_{i-1}) - 1
+                use_prev_i = tf.logical_and(i > 0, tf.gather(use_prev, i))  # [batch_size]
+                next_input = tf.select(use_prev_i, prev_input, given_input)
+                if is_packed:  # A new song starts: the state is reset and the previous output ignored
+                    reset = tf.gather(resets, i)  # [batch_size]
+                    next_input = tf.select(reset, given_input, next_input)
+                    keep = tf.expand_dims(1.0 - tf.to_float(reset), 1)
+                    state = tuple(tf.nn.rnn_cell.LSTMStateTuple(c * keep, h * keep) for c, h in state)
+
+                output, state = rnn_cell(next_input, state)
+                outputs_ta = outputs_ta.write(i, output)
+                return (i + 1, output, outputs_ta) + tuple(t for layer_state in state for t in layer_state)
+
+            initial_output = tf.zeros(tf.pack([batch_size, self.args.hidden_size]))
+            initial_output.set_shape([None, self.args.hidden_size])
+            loop_outputs = tf.while_loop(
+                lambda i, *_: i < nb_steps,
+                loop_rnn,
+                [tf.constant(0), initial_output, outputs_ta] + [t for layer_state in initial_state for t in layer_state]
+            )
+            flat_state = loop_outputs[3:]
+            final_state = tuple(
+                tf.nn.rnn_cell.LSTMStateTuple(flat_state[2*l], flat_state[2*l+1]) for l in range(self.args.num_layers)
+            )
+
+            # Final projection (all steps at once)
+            with tf.name_scope('final_output'):
+                outputs = tf.reshape(loop_outputs[2].pack(), [-1, self.args.hidden_size])  # [time*batch_size, hidden_size]
+                outputs = tf.reshape(project_note(outputs), tf.pack([nb_steps, batch_size, nb_keys]))  # [time, batch_size, nb_keys]
+            return outputs, initial_state, final_state
+
+        # Data parallelism: each tower computes a slice of the batch (training only)
+        nb_towers = 1 if self.args.test else self.args.num_towers
+        tower_inputs = self._split_towers(self.inputs, nb_towers, axis=1)
+        tower_targets = self._split_towers(self.targets, nb_towers, axis=1)
+        tower_use_prev = self._split_towers(self.use_prev, nb_towers, axis=1)
+        tower_resets = self._split_towers(self.resets, nb_towers, axis=1) if is_packed else [None] * nb_towers
+        tower_loss_weights = self._split_towers(self.loss_weights, nb_towers, axis=1) if is_packed else [None] * nb_towers
+
+        if not self.args.test:
+            opt = self._create_optimizer()
+
+        tower_outputs = []
+        tower_final_states = []
+        tower_losses = []
+        for t in range(nb_towers):
+            with tf.device(self._get_tower_device(t, nb_towers)):
+                with tf.variable_scope('rnn_decoder', reuse=True if t else None):  # Same scope as tf.nn.seq2seq.rnn_decoder
+                    outputs, initial_state, final_state = build_tower(tower_inputs[t], tower_use_prev[t], tower_resets[t])
+                if not t:
+                    self.initial_state = initial_state  # Generation (single tower)
+                tower_outputs.append(outputs)
+                tower_final_states.append(final_state)
+
+                # For training only
+                if not self.args.test:
+                    # Same loss as the unrolled graph (see _build_network)
+                    crossent = tf.nn.sigmoid_cross_entropy_with_logits(outputs, tower_targets[t])  # [time, batch_size, nb_keys]
+                    weights = tf.reshape(self.target_weights_policy.get_weights(nb_steps), [-1, 1, 1])
+                    if is_packed:  # No loss across the songs boundaries
+                        weights = weights * tf.expand_dims(tower_loss_weights[t], 2)
+                    loss_fct = tf.reduce_sum(crossent * weights)
+                    tower_losses.append(loss_fct * (self.args.sample_length / tf.to_float(nb_steps)))  # Normalized by bucket
+
+        # Merge the towers
+        if nb_towers == 1:
+            outputs = tower_outputs[0]
+            final_state = tower_final_states[0]
+        else:
+            outputs = tf.concat(1, tower_outputs)
+            final_state = self._concat_states(tower_final_states)
+
+        # The same operators are used for all sequence lengths
+        for length in self.lengths:
+            self.outputs[length] = outputs
+            self.final_state[length] = final_state
 
         # For training only
         if not self.args.test:
-            # Finally, we define the loss function
-
-            # The network will predict a mix a wrong and right notes. For the loss function, we would like to
-            # penalize note which are wrong. Eventually, the penalty should be less if the network predict the same
-            # note but not in the right pitch (ex: C4 instead of C5), with a decay the further the prediction
-            # is (D5 and D1 more penalized than D4 and D3 if the target is D2)
-
-            # For now, by using sigmoid_cross_entropy_with_logits, the task is formulated as a NB_NOTES binary
-            # classification problems
-
-            self.schedule_policy = Model.ScheduledSamplingPolicy(self.args)
-            self.target_weights_policy = Model.TargetWeightsPolicy(self.args)
-            self.learning_rate_policy = Model.LearningRatePolicy(self.args)  # Load the chosen policies
-
-            # TODO: If train on different length, check that the loss is proportional to the length or average ???
-            loss_fct = tf.nn.seq2seq.sequence_loss(
-                self.outputs,
-                self.targets,
-                [tf.constant(self.target_weights_policy.get_weight(i), shape=self.targets[0].get_shape()) for i in range(len(self.targets))],  # Weights
-                softmax_loss_function=tf.nn.sigmoid_cross_entropy_with_logits,
-                average_across_timesteps=False,  # I think it's best for variables length sequences (specially with the target weights=0), isn't it (it implies also that short sequences are less penalized than long ones) ? (TODO: For variables length sequences, be careful about the target weights)
-                average_across_batch=False  # Penalize by sample (should allows dynamic batch size) Warning: need to tune the learning rate
-            )
-            tf.scalar_summary('training_loss', loss_fct)  # Keep track of the cost
+            loss_fct = tf.add_n(tower_losses)  # Sum over the batch
+            loss_summary = tf.scalar_summary('training_loss', loss_fct, collections=[])  # Keep track of the cost
+
+            opt_op = self._minimize(opt, tower_losses)
+            for length in self.lengths:
+                self.loss_summary[length] = loss_summary
+                self.opt_op[length] = opt_op
 
-            self.current_learning_rate = tf.placeholder(tf.float32, [])
+        self._build_single_step(rnn_cell, project_note, nb_keys)
 
-            # Initialize the optimizer
-            opt = tf.train.AdamOptimizer(
-                learning_rate=self.current_learning_rate,
-                beta1=0.9,
-                beta2=0.999,
-                epsilon=1e-08
+    def _build_single_step(self, rnn_cell, project_note, nb_keys):
+        """ Create the operators computing a single time step, sharing the weights of the main graph
+        The state is not kept inside the graph: it is fed and returned at each run, so the caller can hold one state
+        by sequence (ex: live accompaniment, where each frame is predicted when the previous one is played). Has to be
+        called after the main graph creation (the variables are reused).
+        Args:
+            rnn_cell (RNNCell): the cell of the main graph
+            project_note (fct): the projection of the main graph
+            nb_keys (int): keyboard width
+        """
+        with tf.name_scope('placeholder_single_step'):
+            self.single_input = tf.placeholder(tf.float32, [None, nb_keys], name='input')  # -1.0/1.0
+            self.single_state = tuple(
+                tf.nn.rnn_cell.LSTMStateTuple(
+                    tf.placeholder(tf.float32, [None, self.args.hidden_size], name='c'),
+                    tf.placeholder(tf.float32, [None, self.args.hidden_size], name='h'),
+                ) for _ in range(self.args.num_layers)
             )
 
-            # TODO: Also keep track of magnitudes (how much is updated)
-            self.opt_op = opt.minimize(loss_fct)
+        with tf.variable_scope('rnn_decoder', reuse=True):  # Same variables as tf.nn.seq2seq.rnn_decoder
+            output, self.single_final_state = rnn_cell(self.single_input, self.single_state)
+        with tf.name_scope('single_step_output'):
+            self.single_output = project_note(output)
+            self.single_next_input = tf.sub(tf.mul(2.0, tf.nn.sigmoid(self.single_output)), 1.0)  # Same as loop_rnn
+
+    def get_zero_state(self, batch_size):
+        """ Return the initial state of the single step operators (see single_step)
+        Args:
+            batch_size (int): the nb of sequences
+        Return:
+            Tuple[LSTMStateTuple]: the (c, h) arrays of each layer [batch_size, hidden_size]
+        """
+        return tuple(
+            tf.nn.rnn_cell.LSTMStateTuple(
+                np.zeros([batch_size, self.args.hidden_size], dtype=np.float32),
+                np.zeros([batch_size, self.args.hidden_size], dtype=np.float32),
+            ) for _ in range(self.args.num_layers)
+        )
+
+    def single_step(self, inputs, state):
+        """ Operators predicting the next time step only (interactive generation)
+        The state is held by the caller: the returned state has to be given back for the next step. As for step(), the
+        operators are not run here. Ex:
+
+        ```
+        state = model.get_zero_state(1)
+        for keyboard in keyboards:
+            ops, feed_dict = model.single_step(keyboard, state)
+            output, next_input, state = sess.run(ops, feed_dict)
+        ```
+
+        Args:
+            inputs (np.array): the previous keyboard [batch_size, nb_keys] (-1.0/1.0, or the next_input of the
+                previous step to continue the prediction)
+            state (Tuple[LSTMStateTuple]): the state returned by the previous step (or get_zero_state)
+        Return:
+            Tuple[ops], dict: the operators (output logits, next input, new state) with the associated feed dictionary
+        """
+        feed_dict = {self.single_input: inputs}
+        for state_placeholders, state_values in zip(self.single_state, state):
+            for placeholder, value in zip(state_placeholders, state_values):  # (c, h) of each layer
+                feed_dict[placeholder] = value
+        return (self.single_output, self.single_next_input, self.single_final_state), feed_dict
+
+    def _packed_rnn_decoder(self, decoder_inputs, initial_state, cell, loop_function, resets):
+        """ Same as tf.nn.seq2seq.rnn_decoder (same variables names), but the state of each sequence is reset when a
+        new song starts (see self.resets)
+        Args:
+            decoder_inputs (List[tf.Tensor]): the inputs of each step
+            initial_state: the state of the first step
+            cell (RNNCell): the multi-layers LSTM cell
+            loop_function (fct): connect the previous output to the next input
+            resets (List[tf.Tensor]): if the state is reset before each step
+        Return:
+            Tuple[List[tf.Tensor], Tuple]: the outputs of each step and the final state
+        """
+        with tf.variable_scope('rnn_decoder'):
+            state = initial_state
+            outputs = []
+            prev = None
+            for i, inp in enumerate(decoder_inputs):
+                if prev is not None:
+                    with tf.variable_scope('loop_function', reuse=True):
+                        inp = loop_function(prev, i)
+                if i > 0:
+                    tf.get_variable_scope().reuse_variables()
+                keep = tf.expand_dims(1.0 - tf.cast(resets[i], tf.float32), 1)  # [batch_size, 1], 0.0 when reset
+                state = tuple(tf.nn.rnn_cell.LSTMStateTuple(c * keep, h * keep) for c, h in state)
+                output, state = cell(inp, state)
+                outputs.append(output)
+                prev = output
+        return outputs, state
 
     def step(self, batch, train_set=True, glob_step=-1, ret_output=False):
         """ Forward/training step operation.
         Does not perform run on itself but just return the operators to do so. Those have then to be run by the
-        main program.
-        If the output operator is returned, it will always be the last one on the list
+        main program. The operators are the ones of the bucket matching the batch length.
+        On training mode, the first operator is the loss summary. If the output operator is returned, it will always
+        be the last one on the list. On generating mode, the operators are the outputs and the final state (to
+        continue the songs with another call, see Batch.initial_state)
         Args:
             batch (Batch): Input data on testing mode, input and target on output mode
             train_set (Bool): indicate if the batch come from the test/train set
@@ -365,35 +808,65 @@ class Model:
 
         # Feed placeholders and choose the ops
         if not self.args.test:  # Training
+            length = len(batch.inputs)
+            assert length in self.opt_op, 'No bucket for the sequence length {}'.format(length)
+            ops += (self.loss_summary[length],)
+
             if train_set:
                 assert glob_step >= 0
                 feed_dict[self.current_learning_rate] = self.learning_rate_policy.get_learning_rate(glob_step)
 
-            for i in range(self.args.sample_length):
-                feed_dict[self.inputs[i]] = batch.inputs[i]
-                feed_dict[self.targets[i]] = batch.targets[i]
-                #if not train_set or np.random.rand() > self.schedule_policy.get_prev_threshold(glob_step)*self.target_weights_policy.get_weight(i):  # Regular Schedule sample (TODO: Try sampling with the weigths or a mix of weights/sampling)
-                if np.random.rand() > self.schedule_policy.get_prev_threshold(glob_step):  # Weight the threshold by the target weights (don't schedule sample if weight=0)
-                    feed_dict[self.use_prev[i]] = True
-                else:
-                    feed_dict[self.use_prev[i]] = False
+            if self.args.graph == Model.GraphMode.DYNAMIC:  # Single tensors
+                feed_dict[self.inputs] = batch.inputs
+                feed_dict[self.targets] = batch.targets
+                use_prev = np.random.rand(length) > self.schedule_policy.get_prev_threshold(glob_step)  # Same draws as for the unrolled graph
+                feed_dict[self.use_prev] = np.repeat(use_prev[:, np.newaxis], len(batch.inputs[0]), axis=1)  # Same for the whole batch
+                if self.resets is not None:
+                    feed_dict[self.resets] = batch.resets
+                    feed_dict[self.loss_weights] = batch.weights
+            else:
+                batch_size = len(batch.inputs[0])
+                for i in range(length):
+                    feed_dict[self.inputs[i]] = batch.inputs[i]
+                    feed_dict[self.targets[i]] = batch.targets[i]
+                    #if not train_set or np.random.rand() > self.schedule_policy.get_prev_threshold(glob_step)*self.target_weights_policy.get_weight(i):  # Regular Schedule sample (TODO: Try sampling with the weigths or a mix of weights/sampling)
+                    if np.random.rand() > self.schedule_policy.get_prev_threshold(glob_step):  # Weight the threshold by the target weights (don't schedule sample if weight=0)
+                        feed_dict[self.use_prev[i]] = np.ones(batch_size, dtype=bool)
+                    else:
+                        feed_dict[self.use_prev[i]] = np.zeros(batch_size, dtype=bool)
+                    if self.resets is not None:
+                        feed_dict[self.resets[i]] = batch.resets[i]
+                        feed_dict[self.loss_weights[i]] = batch.weights[i]
 
             if train_set:
-                ops += (self.opt_op,)
+                ops += (self.opt_op[length],)
             if ret_output:
-                ops += (self.outputs,)
-        else:  # Generating (batch_size == 1)
+                ops += (self.outputs[length],)
+        else:  # Generating (one sequence by initiator, each one can have a different nb of given steps)
             # TODO: What to put for initialisation state (empty ? random ?) ?
-            # TODO: Modify use_prev
-            for i in range(self.args.sample_length):
-                if i < len(batch.inputs):
-                    feed_dict[self.inputs[i]] = batch.inputs[i]
-                    feed_dict[self.use_prev[i]] = False
-                else:  # Even not used, we still need to feed a placeholder
-                    feed_dict[self.inputs[i]] = batch.inputs[0]  # Could be anything but we need it to be from the right shape
-                    feed_dict[self.use_prev[i]] = True  # When we don't have an input, we use the previous output instead
-
-            ops += (self.outputs,)
+            inputs = np.asarray(batch.inputs)  # [nb_given, batch_size, nb_keys]
+            nb_given = batch.initiator_lengths
+            if nb_given is None:  # All inputs are given
+                nb_given = np.full(inputs.shape[1], len(inputs))
+            inputs = inputs[:self.args.sample_length]
+            # When we don't have an input, we use the previous output instead
+            use_prev = np.arange(self.args.sample_length)[:, np.newaxis] >= nb_given[np.newaxis, :]  # [sample_length, batch_size]
+            if self.args.graph == Model.GraphMode.DYNAMIC:
+                feed_dict[self.inputs] = np.concatenate(
+                    [inputs] + [inputs[:1]] * (self.args.sample_length - len(inputs))  # Not used but need the right shape
+                )
+                feed_dict[self.use_prev] = use_prev
+            else:
+                for i in range(self.args.sample_length):
+                    # Even not used, we still need to feed a placeholder (could be anything but from the right shape)
+                    feed_dict[self.inputs[i]] = inputs[i] if i < len(inputs) else inputs[0]
+                    feed_dict[self.use_prev[i]] = use_prev[i]
+            if batch.initial_state is not None:  # Continue the previous chunk (otherwise, start from the zero state)
+                for state_tensors, state_values in zip(self.initial_state, batch.initial_state):
+                    for tensor, value in zip(state_tensors, state_values):  # (c, h) of each layer
+                        feed_dict[tensor] = value
+
+            ops += (self.outputs[self.args.sample_length], self.final_state[self.args.sample_length])
 
         # Return one pass operator
         return ops, feed_dict
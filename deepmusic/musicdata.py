@@ -20,21 +20,50 @@ Loads the midi song, build the dataset
 from tqdm import tqdm  # Progress bar when creating dataset
 import pickle  # Saving the data
 import os  # Checking file existence
+import collections
+import hashlib  # Identify the midi files content
+import itertools
+import multiprocessing  # Parallel dataset creation
 import numpy as np  # Batch data
 import json
 # TODO: import cv2  # Plot the piano roll
 
 from deepmusic.midiconnector import MidiConnector
 from deepmusic.midiconnector import MidiInvalidException
+from deepmusic.pianoroll import PianoRoll
+from deepmusic.prefetcher import BatchPrefetcher
+from deepmusic.sampler import BucketSampler
+from deepmusic.sampler import PackedSampler
+from deepmusic.sampler import WindowSampler
 import deepmusic.songstruct as music
 
 
+def _init_worker(music_data):
+    """ Initialize a dataset creation process
+    Args:
+        music_data (MusicData): the dataset object used to convert the songs (copied once per worker)
+    """
+    global _worker_music_data
+    _worker_music_data = music_data
+
+
+def _worker_load_file(filename):
+    """ Load a midi file inside a worker process (see MusicData._load_file)
+    """
+    return _worker_music_data._load_file(filename)
+
+
 class Batch:
     """Structure containing batches info
     """
     def __init__(self):
-        self.inputs = []
+        self.inputs = []  # List or array of the inputs of each step ([batch_size, NB_NOTES] each)
         self.targets = []
+        self.resets = None  # Packed songs only: if the RNN state is reset before each input step ([sample_length, batch_size])
+        self.weights = None  # Packed songs only: loss weight of each target step, 0 across songs ([sample_length, batch_size])
+        self.sampler_state = None  # State of the sampler after drawing this batch (to resume the training after it)
+        self.initiator_lengths = None  # Generation only: nb of given input steps of each sequence ([batch_size])
+        self.initial_state = None  # Generation only: LSTM state at the first step (final state of the previous chunk)
 
 
 class MusicData:
@@ -48,10 +77,13 @@ class MusicData:
         """
 
         # Filename and directories constants
-        self.DATA_VERSION = '0.2'  # Assert compatibility between versions
+        self.DATA_VERSION = '0.5'  # Assert compatibility between versions
         self.DATA_DIR_MIDI = 'data/midi'  # Originals midi files
-        self.DATA_DIR_SAMPLES = 'data/samples'  # Training/testing samples after pre-processing
+        self.DATA_DIR_SAMPLES = 'data/samples'  # Training/testing samples after pre-processing (one folder by dataset)
         self.DATA_SAMPLES_EXT = '.pkl'
+        self.MANIFEST_FILENAME = 'manifest.json'  # List the midi files (and their content hash) present on the dataset
+        self.STORE_FILENAME = 'songs.npy'  # All songs packed in a single array (memory mapped when loaded)
+        self.STORE_INDEX_FILENAME = 'songs_index.npy'  # Offset and length of each song inside the store
         self.TEST_INIT_FILE = 'data/test/initiator.json'  # Initial input for the generated songs
         self.FILE_EXT = '.mid'  # Could eventually add support for other format later ?
 
@@ -68,6 +100,8 @@ class MusicData:
         self.songs = []
         self.songs_train = None
         self.songs_test = None
+        self.note_range = list(music.MIDI_NOTES_RANGE)  # Lowest and highest midi notes played on the dataset
+        self.samplers = {}  # The extracts samplers of the train (True) and test (False) sets
 
         if not self.args.test:  # No need to load the dataset when testing
             self._restore_dataset()
@@ -84,88 +118,305 @@ class MusicData:
                 len(self.songs_train),
                 len(self.songs_test))
             )  # TODO: Print average, max, min duration
+            print('Piano rolls: {:.1f}MB bit-packed ({:.1f}MB saved compared to int64 arrays)'.format(
+                sum([song.nbytes for song in self.songs]) / 2**20,
+                sum([song.dense_nbytes - song.nbytes for song in self.songs]) / 2**20)
+            )
 
     def _restore_dataset(self):
         """Load/create the conversations data
+        The samples are cached file by file (one pickle per midi file content) inside data/samples/<dataset_tag>/.
+        A manifest keep track of the content of the midi folder, so only the new or modified files are parsed and
+        the deleted ones are removed from the dataset.
         """
+        midi_dir = os.path.join(self.args.root_dir, self.DATA_DIR_MIDI, self.args.dataset_tag)
+        samples_dir = os.path.join(self.args.root_dir, self.DATA_DIR_SAMPLES, self.args.dataset_tag)
+        os.makedirs(samples_dir, exist_ok=True)
+
+        manifest = self._load_manifest(samples_dir)
+        prev_entries = {entry['file']: entry for entry in manifest['songs'] + manifest['ignored']}
+
+        # Identify the content of each file (the hash is only recomputed if the file has been modified)
+        print('Scanning {}...'.format(midi_dir))
+        entries = collections.OrderedDict()
+        for filename in sorted([f for f in os.listdir(midi_dir) if f.endswith(self.FILE_EXT)]):
+            file_stat = os.stat(os.path.join(midi_dir, filename))
+            entry = prev_entries.get(filename)
+            if entry is None or entry['size'] != file_stat.st_size or entry['mtime'] != file_stat.st_mtime_ns:
+                key = self._hash_file(os.path.join(midi_dir, filename))
+                if entry is None or entry['key'] != key:
+                    entry = {'file': filename, 'key': key}
+                entry['size'] = file_stat.st_size
+                entry['mtime'] = file_stat.st_mtime_ns
+            entries[filename] = entry
+
+        # Parse the new files (the files which have been ignored once are not parsed again)
+        new_files = [
+            filename for filename, entry in entries.items()
+            if 'error' not in entry and not os.path.exists(self._get_sample_path(samples_dir, entry['key']))
+        ]
+        if new_files:
+            print('{} new files found. Updating dataset...'.format(len(new_files)))
+            for filename, piano_roll, msg in self._create_samples([os.path.join(midi_dir, f) for f in new_files]):
+                entry = entries[os.path.basename(filename)]
+                if piano_roll is None:
+                    entry['error'] = msg
+                else:
+                    self._save_samples(self._get_sample_path(samples_dir, entry['key']), piano_roll)
+                    entry['length'] = piano_roll.shape[-1]
+
+        # The files whose sample was already cached without being in the manifest (renamed or duplicated file,
+        # interrupted dataset creation) have no length yet
+        lengths = {entry['key']: entry['length'] for entry in entries.values() if 'length' in entry}
+        for entry in entries.values():
+            if 'error' not in entry and 'length' not in entry:
+                if entry['key'] not in lengths:
+                    lengths[entry['key']] = self._restore_samples(self._get_sample_path(samples_dir, entry['key'])).shape[-1]
+                entry['length'] = lengths[entry['key']]
+
+        # The previous songs keep their position, the new ones are shuffled at the end. Important so the
+        # train/test set will stay the same each time we reload the dataset
+        valid_files = [filename for filename, entry in entries.items() if 'error' not in entry]
+        prev_files = {entry['file'] for entry in manifest['songs']}
+        songs_files = [entry['file'] for entry in manifest['songs'] if entry['file'] in entries and 'error' not in entries[entry['file']]]
+        added_files = [filename for filename in valid_files if filename not in prev_files]
+        np.random.shuffle(added_files)
+        songs_files.extend(added_files)
+
+        manifest['songs'] = [entries[filename] for filename in songs_files]
+        manifest['ignored'] = [entry for entry in entries.values() if 'error' in entry]
+        removed_files = [filename for filename in prev_entries if filename not in entries]
+
+        if not manifest['songs']:
+            raise ValueError('Empty dataset. Check that the folder exist and contains supported midi files.')
 
-        # Construct the dataset name
-        samples_path = os.path.join(
-            self.args.root_dir,
-            self.DATA_DIR_SAMPLES,
-            self.args.dataset_tag + self.DATA_SAMPLES_EXT
+        # Pack all songs together (only if the dataset has changed)
+        store_key = self._get_store_key(manifest)
+        if manifest.get('store') != store_key or not os.path.exists(os.path.join(samples_dir, self.STORE_FILENAME)):
+            print('Packing the dataset...')
+            self._save_store(samples_dir, manifest)
+            manifest['store'] = store_key
+            manifest.pop('note_range', None)
+        if 'note_range' not in manifest:
+            manifest['note_range'] = self._compute_note_range(samples_dir)
+
+        self._save_manifest(samples_dir, manifest)
+        self._clean_samples(samples_dir, manifest)
+
+        print('Restoring dataset from {} ({} new songs, {} removed, {} files ignored)...'.format(
+            samples_dir,
+            len(added_files),
+            len(removed_files),
+            len(manifest['ignored']))
         )
+        self.songs = self._restore_store(samples_dir)
+        self.note_range = manifest['note_range']
+        print('Pitch range: midi notes {} to {} ({} keys used out of {})'.format(
+            self.note_range[0],
+            self.note_range[1],
+            self.note_range[1] - self.note_range[0] + 1,
+            music.NB_NOTES
+        ))
+
+    def _hash_file(self, filename):
+        """ Compute the cache key of the given file
+        The key depends of the file content and of the dataset version
+        Args:
+            filename (str): the midi file
+        Return:
+            str: the hexadecimal key
+        """
+        file_hash = hashlib.sha1(self.DATA_VERSION.encode())
+        with open(filename, 'rb') as handle:
+            file_hash.update(handle.read())
+        return file_hash.hexdigest()
 
-        # Restoring precomputed model
-        if os.path.exists(samples_path):
-            print('Restoring dataset from {}...'.format(samples_path))
-            self._restore_samples(samples_path)
+    def _get_sample_path(self, samples_dir, key):
+        """ Return the path of the cached sample associated with the given key
+        """
+        return os.path.join(samples_dir, key + self.DATA_SAMPLES_EXT)
 
-        # First time we load the database: creating all files
+    def _load_manifest(self, samples_dir):
+        """ Load the list of the files already present in the dataset
+        Args:
+            samples_dir (str): The dataset cache directory
+        Return:
+            dict: the manifest (empty if not found or from a previous version)
+        """
+        manifest = {'version': self.DATA_VERSION, 'songs': [], 'ignored': []}
+        manifest_path = os.path.join(samples_dir, self.MANIFEST_FILENAME)
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as handle:
+                prev_manifest = json.load(handle)
+            if prev_manifest['version'] == self.DATA_VERSION:
+                manifest = prev_manifest
+            else:
+                print('Warning: Dataset version {} does not match {}. Recreating the dataset...'.format(prev_manifest['version'], self.DATA_VERSION))
         else:
             print('Training samples not found. Creating dataset...')
-            self._create_samples()
+        return manifest
+
+    def _save_manifest(self, samples_dir, manifest):
+        """ Save the manifest (the file is replaced atomically so an interrupted run can't corrupt the cache)
+        """
+        manifest_path = os.path.join(samples_dir, self.MANIFEST_FILENAME)
+        with open(manifest_path + '.tmp', 'w') as handle:
+            json.dump(manifest, handle, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
 
-            print('Saving dataset...')
-            np.random.shuffle(self.songs)  # Important to do that before saving so the train/test set will be fixed each time we reload the dataset
-            self._save_samples(samples_path)
+    def _clean_samples(self, samples_dir, manifest):
+        """ Remove the cached samples which does not correspond to any file of the dataset anymore
+        """
+        keys = {entry['key'] for entry in manifest['songs']}
+        for filename in os.listdir(samples_dir):
+            key, ext = os.path.splitext(filename)
+            if ext == self.DATA_SAMPLES_EXT and key not in keys:
+                os.remove(os.path.join(samples_dir, filename))
+
+    def _compute_note_range(self, samples_dir):
+        """ Return the lowest and highest notes played on the whole dataset
+        Args:
+            samples_dir (str): The dataset cache directory (containing the packed songs)
+        Return:
+            List[int]: the min and max (included) midi notes (the full keyboard if the dataset is empty)
+        """
+        store = np.load(os.path.join(samples_dir, self.STORE_FILENAME), mmap_mode='r')
+        played = np.unpackbits(np.bitwise_or.reduce(store, axis=0), count=music.NB_NOTES)  # Keys played at least once
+        keys = np.flatnonzero(played)
+        if not keys.size:
+            return list(music.MIDI_NOTES_RANGE)
+        return [int(keys[0]) + music.MIDI_NOTES_RANGE[0], int(keys[-1]) + music.MIDI_NOTES_RANGE[0]]
+
+    def _get_store_key(self, manifest):
+        """ Compute the key identifying the packed store content (the ordered list of the songs)
+        """
+        store_hash = hashlib.sha1(self.DATA_VERSION.encode())
+        for entry in manifest['songs']:
+            store_hash.update(entry['key'].encode())
+        return store_hash.hexdigest()
+
+    def _save_store(self, samples_dir, manifest):
+        """ Concatenate the cached samples into a single array
+        The array contains the bit-packed songs, has shape [total_length, PianoRoll.NB_BYTES] (the songs are contiguous
+        in memory) and is saved with an index containing the (offset, length) of each song.
+        Args:
+            samples_dir (str): The dataset cache directory
+            manifest (dict): the ordered list of songs
+        """
+        lengths = np.array([entry['length'] for entry in manifest['songs']], dtype=np.int64)
+        index = np.stack([np.cumsum(lengths) - lengths, lengths], axis=1)  # [nb_songs, (offset, length)]
+
+        store_path = os.path.join(samples_dir, self.STORE_FILENAME)
+        index_path = os.path.join(samples_dir, self.STORE_INDEX_FILENAME)
+
+        # Written in a temporary file first, so an interrupted run never leave an inconsistent store
+        store = np.lib.format.open_memmap(store_path + '.tmp', mode='w+', dtype=np.uint8, shape=(int(lengths.sum()), PianoRoll.NB_BYTES))
+        for entry, (offset, length) in zip(tqdm(manifest['songs']), index):
+            store[offset:offset+length] = self._restore_samples(self._get_sample_path(samples_dir, entry['key'])).packed
+        store.flush()
+        del store
+        with open(index_path + '.tmp', 'wb') as handle:
+            np.save(handle, index)
+
+        os.replace(store_path + '.tmp', store_path)
+        os.replace(index_path + '.tmp', index_path)
+
+    def _restore_store(self, samples_dir):
+        """ Map the packed store in memory
+        The store is opened read-only with np.memmap, so nothing is loaded until a song is accessed and the pages
+        are shared between all the processes using the same dataset.
+        Args:
+            samples_dir (str): The dataset cache directory
+        Return:
+            List[PianoRoll]: The songs, as views on the store
+        """
+        store = np.load(os.path.join(samples_dir, self.STORE_FILENAME), mmap_mode='r')
+        index = np.load(os.path.join(samples_dir, self.STORE_INDEX_FILENAME))
+        return [PianoRoll(store[offset:offset+length]) for offset, length in index]
 
     def _restore_samples(self, samples_path):
-        """ Load samples from file
+        """ Load a sample from file
         Args:
-            samples_path (str): The path where to load the model (all dirs should exist)
+            samples_path (str): The path where to load the sample (all dirs should exist)
         Return:
-            List[Song]: The training data
+            PianoRoll: The song piano roll
         """
         with open(samples_path, 'rb') as handle:
-            data = pickle.load(handle)  # Warning: If adding something here, also modifying saveDataset
+            data = pickle.load(handle)  # Warning: If adding something here, also modifying _save_samples
 
             # Check the version
             current_version = data['version']
             if current_version != self.DATA_VERSION:
                 raise UserWarning('Present configuration version {0} does not match {1}.'.format(current_version, self.DATA_VERSION))
 
-            # Restore parameters
-            self.songs = data['songs']
+            return data['song']
 
-    def _save_samples(self, samples_path):
-        """ Save samples to file
+    def _save_samples(self, samples_path, piano_roll):
+        """ Save a sample to file
         Args:
-            samples_path (str): The path where to save the model (all dirs should exist)
+            samples_path (str): The path where to save the sample (all dirs should exist)
+            piano_roll (PianoRoll): The song to save
         """
 
         with open(samples_path, 'wb') as handle:
-            data = {  # Warning: If adding something here, also modifying loadDataset
+            data = {  # Warning: If adding something here, also modifying _restore_samples
                 'version': self.DATA_VERSION,
-                'songs': self.songs
+                'song': piano_roll
             }
             pickle.dump(data, handle, -1)  # Using the highest protocol available
 
-    def _create_samples(self):
-        """ Create the database from the midi files
+    def _create_samples(self, midi_files):
+        """ Parse the given midi files
+        The files are parsed by a pool of args.dataset_workers processes. The results are returned in the same
+        order as the given file list, whatever the number of workers.
+        Args:
+            midi_files (List[str]): the midi files to load
+        Return:
+            Generator[Tuple[str, PianoRoll, str]]: the loaded files (see _load_file)
         """
-        midi_dir = os.path.join(self.args.root_dir, self.DATA_DIR_MIDI, self.args.dataset_tag)
-        midi_files = [os.path.join(midi_dir, f) for f in os.listdir(midi_dir) if f.endswith(self.FILE_EXT)]
-
-        for filename in tqdm(midi_files):
-
-            try:
-                new_song = MidiConnector.load_file(filename)
-            except MidiInvalidException as e:
-                tqdm.write('File ignored ({}): {}'.format(filename, e))
-            else:
-                self.songs.append(self._convert_song2array(new_song))
-                tqdm.write('Song loaded {}: {} tracks, {} notes, {} ticks/beat'.format(
-                    filename,
-                    len(new_song.tracks),
-                    sum([len(t.notes) for t in new_song.tracks]),
-                    new_song.ticks_per_beat)
-                )
-
-        if not self.songs:
-            raise ValueError('Empty dataset. Check that the folder exist and contains supported midi files.')
+        nb_workers = self.args.dataset_workers or multiprocessing.cpu_count()
+        nb_workers = min(nb_workers, len(midi_files))
+
+        if nb_workers > 1:
+            print('Parsing {} files with {} workers...'.format(len(midi_files), nb_workers))
+            pool = multiprocessing.Pool(nb_workers, initializer=_init_worker, initargs=(self,))
+            chunksize = max(1, len(midi_files) // (16*nb_workers))  # Small chunks so the progress bar stay fluid
+            results = pool.imap(_worker_load_file, midi_files, chunksize)  # imap keep the order of the files
+        else:
+            pool = None
+            results = map(self._load_file, midi_files)
 
-        pass
+        try:
+            for filename, piano_roll, msg in tqdm(results, total=len(midi_files)):
+                if piano_roll is None:
+                    tqdm.write('File ignored ({}): {}'.format(filename, msg))
+                else:
+                    tqdm.write('Song loaded {}: {}'.format(filename, msg))
+                yield filename, piano_roll, msg
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    def _load_file(self, filename):
+        """ Parse and convert a single midi file
+        Can be called from a worker process, so the errors are returned instead of printed.
+        Args:
+            filename (str): the midi file to load
+        Return:
+            Tuple[str, PianoRoll, str]: the filename, the piano roll (None if the file is invalid) and the
+                song stats (or the reason why the file has been ignored)
+        """
+        try:
+            new_song = MidiConnector.load_file(filename, fast=self.args.midi_parser == 'fast')
+        except MidiInvalidException as e:
+            return filename, None, str(e)
+
+        msg = '{} tracks, {} notes, {} ticks/beat'.format(
+            len(new_song.tracks),
+            sum([len(t.notes) for t in new_song.tracks]),
+            new_song.ticks_per_beat
+        )
+        return filename, self._convert_song2array(new_song), msg
 
     def _convert_song2array(self, song):
         """ Convert a given song to a numpy multi-dimensional array (piano roll)
@@ -176,7 +427,7 @@ class MusicData:
         Args:
             song (Song): The song to convert
         Return:
-            Array: the numpy array: a binary matrix of shape [NB_NOTES, song_length]
+            PianoRoll: the bit-packed binary matrix of shape [NB_NOTES, song_length]
         """
 
         # Convert the absolute ticks in standardized unit
@@ -186,15 +437,12 @@ class MusicData:
         # TODO: Not sure why this plot a decimal value (x.66). Investigate...
         # print(song_length/scale)
 
-        # Use sparse array instead ?
-        piano_roll = np.zeros([music.NB_NOTES, int(np.ceil(song_length/scale))], dtype=int)
-
-        # Adding all notes
-        for track in song.tracks:
-            for note in track.notes:
-                piano_roll[note.get_relative_note()][note.tick//scale] = 1
+        # Gather the notes of all tracks
+        notes = np.concatenate([track.pitches for track in song.tracks]) - music.MIDI_NOTES_RANGE[0]  # Relative notes
+        ticks = np.concatenate([track.ticks for track in song.tracks])
 
-        return piano_roll
+        # Use sparse array instead ?
+        return PianoRoll.from_notes(notes, ticks//scale, int(np.ceil(song_length/scale)))
 
     def _convert_array2song(self, array):
         """ Create a new song from a numpy array
@@ -203,7 +451,8 @@ class MusicData:
         For now, the changes of tempo are ignored. Only 4/4 is supported.
         Warning: All note have the same duration, the default value defined in music.Note
         Args:
-            np.array: the numpy array (Warning: could be a array of int or float containing the prediction before the sigmoid)
+            np.array: the numpy array of shape [nb_keys, song_length], on the note range of the model (Warning: could be
+                a array of int or float containing the prediction before the sigmoid)
         Return:
             song (Song): The song to convert
         """
@@ -213,14 +462,13 @@ class MusicData:
 
         scale = self._get_scale(new_song)
 
-        for index, x in np.ndenumerate(array):  # Add some notes
-            if x > 1e-12:  # Note added (TODO: What should be the condition, =1 ? sigmoid>0.5 ?)
-                new_note = music.Note()
-
-                new_note.set_relative_note(index[0])
-                new_note.tick = index[1] * scale  # Absolute time in tick from the beginning
-
-                main_track.notes.append(new_note)
+        # Note added (TODO: What should be the condition, =1 ? sigmoid>0.5 ?)
+        notes, ticks = np.nonzero(array > 1e-12)  # Same order as a np.ndenumerate loop
+        main_track.add_notes(
+            ticks * scale,  # Absolute time in tick from the beginning
+            notes + self.args.note_range[0],  # Absolute midi notes
+            music.Note().duration  # Default duration
+        )
 
         new_song.tracks.append(main_track)
 
@@ -248,6 +496,10 @@ class MusicData:
         self.songs_train = self.songs[:split_nb]
         self.songs_test = self.songs[split_nb:]
 
+        # Distributed training: each worker trains on its own shard of the training set
+        if self.args.job_name == 'worker':
+            self.songs_train = self.songs_train[self.args.task_index::len(self.args.worker_hosts)]
+
     def get_batches(self, train_set=True):
         """Prepare the batches for the current epoch
         Args:
@@ -255,83 +507,205 @@ class MusicData:
         Return:
             List[Batch]: Get a list of the batches for the next epoch
         """
-        batches = []
+        return list(self.iter_batches(train_set))
 
-        # TODO: Create batches (randomly cut each song in some small parts (need to know the total length for that)
-        # then create the big matrix (NB_NOTE*sample_length) and turn that into batch). If process too long,
-        # could save the created batches in a new folder, data/samples or save/model.
+    def iter_batches(self, train_set=True, nb_batches=None):
+        """ Stream the batches
+        Only the extracts positions are drawn here (see BucketSampler), the windows are cut and the batches created
+        in background (see BatchPrefetcher) while the previous ones are used.
+        Args:
+            train_set (Bool): Indicate on which training/testing set compute the batches
+            nb_batches (int): nb of batches to generate (one epoch if None, infinite if 0)
+        Return:
+            BatchPrefetcher: Iterator over the batches
+        """
+        sampler = self.get_sampler(train_set)
+        if nb_batches is None:  # One epoch (0 is kept for the infinite stream)
+            nb_batches = sampler.epoch_size
+            if nb_batches == 0:
+                raise ValueError('Empty epoch: the {} set is too small for a single batch of {} extracts'.format(
+                    'train' if train_set else 'test',
+                    self.args.batch_size
+                ))
+        songs_set = self.songs_train if train_set else self.songs_test
+        is_transposed = train_set and self.args.transpose > 0  # Only the training set is augmented
+
+        def draw_samples():
+            sample_length, extracts = sampler.draw()
+            if self.args.pack_songs:
+                samples = [[(songs_set[i], start, length) for i, start, length in segments] for segments in extracts]
+            else:
+                songs_ids, starts = extracts
+                samples = [(songs_set[i], start) for i, start in zip(songs_ids, starts)]
+            transpositions = sampler.draw_transpositions(len(samples)) if is_transposed else None
+            return samples, sample_length, transpositions, sampler.get_state()
+
+        def create_batch(drawn):
+            samples, sample_length, transpositions, sampler_state = drawn
+            if self.args.pack_songs:
+                batch = self._create_packed_batch(samples, sample_length, transpositions)
+            else:
+                batch = self._create_batch(samples, sample_length, transpositions)
+            batch.sampler_state = sampler_state  # The sampler is ahead of the consumer (prefetching)
+            return batch
+
+        # The extracts are drawn lazily, when the batch is queued
+        samples = (draw_samples() for _ in (itertools.count() if nb_batches == 0 else range(nb_batches)))
+        return BatchPrefetcher(
+            create_batch,
+            samples,
+            self.args.prefetch,
+            self.args.batch_workers,
+            nb_batches=None if nb_batches == 0 else nb_batches
+        )
 
-        # TODO: Create batches from multiples length (buckets). How to change the loss functions weights (longer
-        # sequences more penalized ?)
+    def get_sampler(self, train_set=True):
+        """ Return the sampler choosing the extracts of the given set (created at the first call)
+        Args:
+            train_set (Bool): Indicate on which training/testing set the sampler draws
+        Return:
+            BucketSampler: the sampler of the set (one WindowSampler, or PackedSampler if the songs are packed, by
+            sample length)
+        """
+        if train_set not in self.samplers:
+            # TODO: Add mode to only start at the begining of a bar
+            songs_set = self.songs_train if train_set else self.songs_test
+            songs_lengths = [song.shape[-1] for song in songs_set]  # The last dimension correspond to the song duration
+            sampler_class = PackedSampler if self.args.pack_songs else WindowSampler
+            samplers = {}
+            for sample_length in self.args.buckets:
+                sampler = sampler_class(
+                    songs_lengths,
+                    sample_length+1,  # We add 1 because each input has to predict the next output
+                    self.args.batch_size
+                )
+                if sampler.nb_ignored:
+                    print('Warning: {} songs of the {} set are too short for the sample length {} and will be ignored{}'.format(
+                        sampler.nb_ignored,
+                        'train' if train_set else 'test',
+                        sample_length,
+                        '' if self.args.pack_songs else ' (use --pack_songs to keep them)'
+                    ))
+                samplers[sample_length] = sampler
+            self.samplers[train_set] = BucketSampler(samplers)
+        return self.samplers[train_set]
+
+    def _create_batch(self, samples, sample_length, transpositions=None):
+        """ Cut the song extracts and create the batch
+        All windows are unpacked at once into a contiguous [sample_length+1, batch_size, nb_keys] tensor.
+        Args:
+            samples (List[Tuple[PianoRoll, int]]): the songs and the start of each extract
+            sample_length (int): the nb of steps of the batch
+            transpositions (np.array): if set, the random values choosing the pitch shift of each extract
+        Return:
+            Batch: the inputs (-1.0/1.0) and targets (0.0/1.0), as arrays of shape [sample_length, batch_size, nb_keys]
+            (nb_keys depends of the note range used by the model)
+        """
+        sample_subsampling_length = sample_length+1  # We add 1 because each input has to predict the next output
 
-        # TODO: Optimize memory management
+        packed = np.stack([song.packed[start:start+sample_subsampling_length] for song, start in samples], axis=1)  # [sample_length+1, batch_size, NB_BYTES]
+        windows = self._unpack_windows(packed)  # [sample_length+1, batch_size, nb_keys]
+        if transpositions is not None:
+            windows = self._transpose(windows, transpositions)
 
-        # First part: Randomly extract subsamples of the songs
-        print('Subsampling songs ({})...'.format('train' if train_set else 'test'))
+        batch = Batch()
+        batch.inputs, batch.targets = self._scale_windows(windows)
+        return batch
 
-        sample_subsampling_length = self.args.sample_length+1  # We add 1 because each input has to predict the next output
+    def _create_packed_batch(self, samples, sample_length, transpositions=None):
+        """ Concatenate the song segments of each extract and create the batch
+        The steps where a new song starts are marked: the RNN state is reset before the input and the target of the
+        previous step (which belongs to the next song) is not penalized.
+        Args:
+            samples (List[List[Tuple[PianoRoll, int, int]]]): the segments (song, start, length) of each extract
+            sample_length (int): the nb of steps of the batch
+            transpositions (np.array): if set, the random values choosing the pitch shift of each extract
+        Return:
+            Batch: the inputs, targets, resets and weights
+        """
+        sample_subsampling_length = sample_length+1  # We add 1 because each input has to predict the next output
+
+        packed = np.empty([sample_subsampling_length, len(samples), PianoRoll.NB_BYTES], dtype=np.uint8)
+        song_starts = np.zeros([sample_subsampling_length, len(samples)], dtype=bool)  # Steps where a new song begins
+        for i, segments in enumerate(samples):
+            position = 0
+            for song, start, length in segments:
+                packed[position:position+length, i] = song.packed[start:start+length]
+                song_starts[position, i] = position > 0  # The first step of the window is always a new sequence
+                position += length
+        windows = self._unpack_windows(packed)  # [sample_length+1, batch_size, nb_keys]
+        if transpositions is not None:
+            windows = self._transpose(windows, transpositions)
+
+        batch = Batch()
+        batch.inputs, batch.targets = self._scale_windows(windows)
+        batch.resets = song_starts[:-1]
+        batch.weights = (~song_starts[1:]).astype(np.float32)  # The last step of a song does not predict the next one
+        return batch
 
-        sub_songs = []
-        if train_set:
-            songs_set = self.songs_train
-        else:
-            songs_set = self.songs_test
-        for song in songs_set:
-            len_song = song.shape[-1]  # The last dimension correspond to the song duration
-            max_start = len_song - sample_subsampling_length
-            assert max_start >= 0  # TODO: Error handling (and if =0, compatible with randint ?)
-            nb_sample_song = 2*len_song // self.args.sample_length  # The number of subsample is proportional to the song length
-            for _ in range(nb_sample_song):
-                start = np.random.randint(max_start)  # TODO: Add mode to only start at the begining of a bar
-                sub_song = song[:, start:start+sample_subsampling_length]
-                sub_songs.append(sub_song)
-
-        # Second part: Shuffle the song extracts
-        print("Shuffling the dataset...")
-        np.random.shuffle(sub_songs)
-
-        # Third part: Group the samples together to create the batches
-        print("Generating batches...")
-
-        def gen_next_samples():
-            """ Generator over the mini-batch training samples
-            Warning: the last samples will be ignored if the number of batch does not match the number of samples
-            """
-            nb_samples = len(sub_songs)
-            for i in range(nb_samples//self.args.batch_size):
-                yield sub_songs[i*self.args.batch_size:(i+1)*self.args.batch_size]
-
-        for samples in gen_next_samples():  # TODO: tqdm with persist = False / will this work with generators ?
-            batch = Batch()
-
-            # samples has shape [batch_size, NB_NOTES, sample_subsampling_length]
-            assert len(samples) == self.args.batch_size
-            assert samples[0].shape == (music.NB_NOTES, sample_subsampling_length)
-
-            # Define targets and inputs
-            for i in range(self.args.sample_length):
-                input = -np.ones([len(samples), music.NB_NOTES])
-                target = np.zeros([len(samples), music.NB_NOTES])
-                for j, sample in enumerate(samples):  # len(samples) == self.args.batch_size
-                    # TODO: Could reuse boolean idx computed (from target to next input)
-                    input[j, sample[:, i] == 1] = 1.0
-                    target[j, sample[:, i+1] == 1] = 1.0
-
-                batch.inputs.append(input)
-                batch.targets.append(target)
-
-            batches.append(batch)
-
-        # Use tf.train.batch() ??
-
-        # TODO: Save some batches as midi to see if correct
-
-        return batches
+    @staticmethod
+    def _scale_windows(windows):
+        """ Create the inputs and targets of the batch from the binary windows
+        Both are views on a single contiguous float32 buffer [2, sample_length, batch_size, nb_keys], filled in place
+        (no intermediate float tensor).
+        Args:
+            windows (np.array): the binary extracts [sample_length+1, batch_size, nb_keys]
+        Return:
+            np.array, np.array: the inputs (-1.0/1.0) and targets (0.0/1.0) [sample_length, batch_size, nb_keys]
+        """
+        buffer = np.empty((2,) + windows[1:].shape, dtype=np.float32)
+        inputs, targets = buffer[0], buffer[1]
+        np.multiply(windows[:-1], 2.0, out=inputs, casting='unsafe')  # The input at step i is the target of step i-1
+        np.subtract(inputs, 1.0, out=inputs)
+        np.copyto(targets, windows[1:], casting='unsafe')
+        return inputs, targets
+
+    def _unpack_windows(self, packed):
+        """ Unpack the extracts, cropped on the keyboard range used by the model (args.note_range)
+        Only the bytes containing the range are unpacked.
+        Args:
+            packed (np.array): the bit-packed extracts [sample_length+1, batch_size, NB_BYTES]
+        Return:
+            np.array: the binary extracts [sample_length+1, batch_size, nb_keys]
+        """
+        first_key = self.args.note_range[0] - music.MIDI_NOTES_RANGE[0]
+        last_key = self.args.note_range[1] - music.MIDI_NOTES_RANGE[0]
+        first_byte = first_key // 8
+        windows = np.unpackbits(packed[:, :, first_byte:last_key//8 + 1], axis=2)
+        return windows[:, :, first_key - 8*first_byte:last_key - 8*first_byte + 1]
+
+    def _transpose(self, windows, transpositions):
+        """ Shift the pitch of each extract (data augmentation)
+        The shift is an offset on the keyboard axis, chosen in [-transpose, transpose] but restricted so the lowest
+        and highest notes of the extract stay on the keyboard (MIDI_NOTES_RANGE, or the cropped note range). The
+        songs are never copied, only the unpacked windows are shifted.
+        Args:
+            windows (np.array): the binary extracts [sample_length+1, batch_size, nb_keys]
+            transpositions (np.array): uniform values on [0, 1) choosing the shift of each extract [batch_size]
+        Return:
+            np.array: the transposed extracts [sample_length+1, batch_size, nb_keys]
+        """
+        nb_keys = windows.shape[2]
+        played = windows.any(axis=0)  # [batch_size, nb_keys]
+        lowest = np.where(played.any(axis=1), np.argmax(played, axis=1), nb_keys-1)
+        highest = np.where(played.any(axis=1), nb_keys-1 - np.argmax(played[:, ::-1], axis=1), 0)
+        min_shifts = np.maximum(-self.args.transpose, -lowest)
+        max_shifts = np.minimum(self.args.transpose, nb_keys-1 - highest)
+        shifts = min_shifts + (transpositions * (max_shifts - min_shifts + 1)).astype(np.int64)  # [batch_size]
+
+        # The key i of the transposed extract is the key i-shift of the original one
+        keys = np.arange(nb_keys)[np.newaxis, :] - shifts[:, np.newaxis]  # [batch_size, nb_keys]
+        on_keyboard = (keys >= 0) & (keys < nb_keys)
+        transposed = np.take_along_axis(windows, np.clip(keys, 0, nb_keys-1)[np.newaxis], axis=2)
+        return transposed * on_keyboard  # The keys shifted from outside the keyboard are empty
 
     def get_batches_test(self):
-        """ Return the batches which initiate the RNN when generating
-        The initial batches are loaded from a json file containing the first notes of the song. The note values
-        are the standard midi ones. Here is an examples of an initiator file:
+        """ Return the batch which initiate the RNN when generating
+        The initiators are loaded from a json file containing the first notes of the song. The note values
+        are the standard midi ones (the notes outside the note range of the model are ignored). All the initiators
+        are grouped in a single batch (one sequence each), so the songs are generated in one run. Because the
+        initiators can have different lengths, the inputs are padded and the nb of given steps of each sequence is
+        stored in batch.initiator_lengths. Here is an examples of an initiator file:
 
         ```
         {"initiator":[
@@ -349,29 +723,29 @@ class MusicData:
         ```
 
         Return:
-            List[Batch], List[str]: The generated batches with the associated names
+            Batch, List[str]: The generation batch with the name of each of its sequences
         """
-        assert self.args.batch_size == 1
-
-        batches = []
-        names = []
-
         with open(self.TEST_INIT_FILE) as init_file:
-            initiators = json.load(init_file)
+            initiators = json.load(init_file)['initiator']
 
-        for initiator in initiators['initiator']:
-            batch = Batch()
+        names = [initiator['name'] for initiator in initiators]
+        lowest_note, highest_note = self.args.note_range
 
-            for seq in initiator['seq']:  # We add a few notes
-                new_input = -np.ones([self.args.batch_size, music.NB_NOTES])  # No notes played by default
+        batch = Batch()
+        batch.initiator_lengths = np.array([len(initiator['seq']) for initiator in initiators])
+        batch.inputs = -np.ones(  # No notes played by default (also for the padding steps)
+            [max(batch.initiator_lengths), len(initiators), highest_note - lowest_note + 1],
+            dtype=np.float32
+        )
+        for j, initiator in enumerate(initiators):
+            for i, seq in enumerate(initiator['seq']):  # We add a few notes
                 for note in seq['notes']:
-                    new_input[0, note] = 1.0
-                batch.inputs.append(new_input)
-
-            names.append(initiator['name'])
-            batches.append(batch)
+                    if not lowest_note <= note <= highest_note:
+                        print('Warning: note {} of {} outside the model range, ignored'.format(note, initiator['name']))
+                        continue
+                    batch.inputs[i, j, note - lowest_note] = 1.0  # Position on the keyboard
 
-        return batches, names
+        return batch, names
 
     @staticmethod
     def _convert_to_piano_rolls(outputs):
@@ -384,18 +758,8 @@ class MusicData:
         """
 
         # Extract the batches and recreate the array for each batch
-        piano_rolls = []
-        for i in range(outputs[0].shape[0]):  # Iterate over the batches
-            piano_roll = None
-            for j in range(len(outputs)):  # Iterate over the sample length
-                # outputs[j][i, :] has shape [NB_NOTES, 1]
-                if piano_roll is None:
-                    piano_roll = [outputs[j][i, :]]
-                else:
-                    piano_roll = np.append(piano_roll, [outputs[j][i, :]], axis=0)
-            piano_rolls.append(piano_roll.T)
-
-        return piano_rolls
+        outputs = np.asarray(outputs)  # [sample_length, batch_size, nb_keys]
+        return [outputs[:, i, :].T for i in range(outputs.shape[1])]  # Iterate over the batches
 
     def visit_recorder(self, outputs, base_dir, base_name, recorders):
         """ Save the predicted output songs using the given recorder
@@ -0,0 +1,206 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Generation network running with numpy only (no TensorFlow needed)
+
+"""
+
+import numpy as np
+
+
+class NumpyModel:
+    """ Same network as model_old.Model (LSTM stack and note projection), for the generation only
+    The weights are loaded from a file created by NumpyModel.export (from the variables of a checkpoint). The
+    computations follow tf.nn.rnn_cell.BasicLSTMCell, so the outputs are the ones of Model.step (up to the float
+    precision).
+    The file can also be quantized (see NumpyModel.quantize): the matrices are then stored as int8 (4 times smaller
+    files) with a scale by output channel. They are converted back to float once, when loaded: numpy has no fast
+    integer product (int8 products run on int32 without BLAS, many times slower than the float ones), so the
+    generation speed and memory are the ones of the float model.
+    """
+    # Name of the variables in the TensorFlow checkpoints
+    LSTM_VARIABLE = 'rnn_decoder/MultiRNNCell/Cell{}/BasicLSTMCell/Linear/{}'  # Layer, Matrix/Bias
+    PROJECTION_VARIABLE = 'note_projection_weights/{}'  # weights/bias
+
+    FORGET_BIAS = 1.0  # Default value of BasicLSTMCell
+
+    def __init__(self, filename):
+        """
+        Args:
+            filename (str): the exported model (.npz)
+        """
+        with np.load(filename) as data:
+            self.note_range = data['note_range'].tolist()  # Midi notes of the first and last keys
+            self.sample_length = int(data['sample_length'])  # Default generation length
+            self.matrices = [data['lstm_matrix_{}'.format(l)] for l in range(int(data['num_layers']))]
+            self.biases = [data['lstm_bias_{}'.format(l)] for l in range(int(data['num_layers']))]
+            self.W = data['projection_weights']
+            self.b = data['projection_bias']
+            self.stored_nbytes = sum(data[name].nbytes for name in data.files)  # Size of the weights in the file
+
+            # Quantized model: the matrices are scaled back by column
+            self.is_quantized = 'projection_weights_scale' in data
+            if self.is_quantized:
+                self.matrices = [
+                    _dequantize_matrix(matrix, data['lstm_matrix_{}_scale'.format(l)]) for l, matrix in enumerate(self.matrices)
+                ]
+                self.W = _dequantize_matrix(self.W, data['projection_weights_scale'])
+
+        self.num_layers = len(self.matrices)
+        self.hidden_size = self.W.shape[0]
+
+    @property
+    def nbytes(self):
+        """ Nb of bytes used in memory by the weights (all of them are read for each generated step, float for the
+        quantized models too, see stored_nbytes for the size in the file)
+        """
+        return sum(a.nbytes for a in self.matrices + self.biases + [self.W, self.b])
+
+    @staticmethod
+    def export(variables, filename, note_range, sample_length):
+        """ Save the weights of the network
+        Args:
+            variables (Dict[str, np.array]): the values of the variables of the model, by name (ex: the content of a
+                checkpoint, the training variables like the optimizer slots are ignored)
+            filename (str): the exported model (.npz)
+            note_range (List[int]): the midi notes of the first and last keys of the model
+            sample_length (int): the default generation length
+        """
+        weights = {
+            'note_range': np.asarray(note_range),
+            'sample_length': np.asarray(sample_length),
+            'projection_weights': variables[NumpyModel.PROJECTION_VARIABLE.format('weights')],
+            'projection_bias': variables[NumpyModel.PROJECTION_VARIABLE.format('bias')],
+        }
+        num_layers = 0
+        while NumpyModel.LSTM_VARIABLE.format(num_layers, 'Matrix') in variables:
+            weights['lstm_matrix_{}'.format(num_layers)] = variables[NumpyModel.LSTM_VARIABLE.format(num_layers, 'Matrix')]
+            weights['lstm_bias_{}'.format(num_layers)] = variables[NumpyModel.LSTM_VARIABLE.format(num_layers, 'Bias')]
+            num_layers += 1
+        if not num_layers:
+            raise ValueError('No LSTM variable found (unknown model format)')
+        weights['num_layers'] = np.asarray(num_layers)
+
+        np.savez(filename, **weights)
+
+    @staticmethod
+    def quantize(filename, quantized_filename):
+        """ Convert the weights of an exported model to int8 (post-training quantization)
+        The matrices (LSTM and projection) are quantized symmetrically with one scale by output channel (column), so
+        each unit keeps its own dynamic. The biases stay in float.
+        Args:
+            filename (str): the exported model (.npz, float weights)
+            quantized_filename (str): the quantized model (.npz)
+        """
+        with np.load(filename) as data:
+            weights = dict(data)
+        if 'projection_weights_scale' in weights:
+            raise ValueError('The model {} is already quantized'.format(filename))
+
+        names = ['lstm_matrix_{}'.format(l) for l in range(int(weights['num_layers']))] + ['projection_weights']
+        for name in names:
+            weights[name], weights[name + '_scale'] = _quantize_matrix(weights[name])
+
+        np.savez(quantized_filename, **weights)
+
+    def get_zero_state(self, batch_size):
+        """ Return the initial state (same as Model.get_zero_state)
+        Args:
+            batch_size (int): the nb of sequences
+        Return:
+            List[Tuple[np.array, np.array]]: the (c, h) arrays of each layer [batch_size, hidden_size]
+        """
+        return [
+            (np.zeros([batch_size, self.hidden_size], dtype=np.float32),
+             np.zeros([batch_size, self.hidden_size], dtype=np.float32))
+            for _ in range(self.num_layers)
+        ]
+
+    def single_step(self, inputs, state):
+        """ Predict the next time step (same as Model.single_step)
+        Args:
+            inputs (np.array): the previous keyboard [batch_size, nb_keys] (-1.0/1.0, or the next input of the previous
+                step to continue the prediction)
+            state (List[Tuple[np.array, np.array]]): the state returned by the previous step (or get_zero_state)
+        Return:
+            np.array, np.array, List[Tuple[np.array, np.array]]: the output logits, the next input and the new state
+        """
+        x = inputs
+        new_state = []
+        for (c, h), matrix, bias in zip(state, self.matrices, self.biases):
+            concat = np.dot(np.concatenate([x, h], axis=1), matrix) + bias
+            i, j, f, o = np.split(concat, 4, axis=1)  # Input gate, new input, forget gate, output gate
+            c = c * _sigmoid(f + NumpyModel.FORGET_BIAS) + _sigmoid(i) * np.tanh(j)
+            h = np.tanh(c) * _sigmoid(o)
+            new_state.append((c, h))
+            x = h
+
+        output = np.dot(x, self.W) + self.b
+        return output, 2.0 * _sigmoid(output) - 1.0, new_state
+
+    def generate(self, inputs, initiator_lengths=None, nb_steps=None):
+        """ Generate the songs (same as Model.step on generating mode)
+        Args:
+            inputs (np.array): the initiators [nb_given, batch_size, nb_keys] (padded if the lengths are different)
+            initiator_lengths (np.array): the nb of given steps of each sequence (all given by default)
+            nb_steps (int): the length of the generated songs (sample_length by default)
+        Return:
+            np.array: the outputs of each step [nb_steps, batch_size, nb_keys]
+        """
+        inputs = np.asarray(inputs, dtype=np.float32)
+        nb_steps = nb_steps or self.sample_length
+        if initiator_lengths is None:
+            initiator_lengths = np.full(inputs.shape[1], len(inputs))
+
+        state = self.get_zero_state(inputs.shape[1])
+        outputs = []
+        next_input = inputs[0]
+        for i in range(nb_steps):
+            if i < len(inputs):  # When we don't have an input, we use the previous output instead
+                next_input = np.where((i < initiator_lengths)[:, np.newaxis], inputs[i], next_input)
+            output, next_input, state = self.single_step(next_input, state)
+            outputs.append(output)
+        return np.asarray(outputs)
+
+
+def _quantize_matrix(matrix):
+    """ Symmetric int8 quantization, by column
+    Args:
+        matrix (np.array): float matrix [nb_inputs, nb_outputs]
+    Return:
+        np.array, np.array: the int8 matrix and the float scale of each column [nb_outputs]
+    """
+    scale = np.max(np.abs(matrix), axis=0) / 127.0
+    scale[scale == 0] = 1.0  # Empty column (all values are 0 anyway)
+    quantized = np.clip(np.round(matrix / scale), -127, 127).astype(np.int8)
+    return quantized, scale.astype(np.float32)
+
+
+def _dequantize_matrix(quantized, scale):
+    """ Inverse of _quantize_matrix
+    Args:
+        quantized (np.array): int8 matrix [nb_inputs, nb_outputs]
+        scale (np.array): float scale of each column [nb_outputs]
+    Return:
+        np.array: the float32 matrix
+    """
+    return quantized.astype(np.float32) * scale
+
+
+def _sigmoid(x):
+    """ Logistic function (as tf.nn.sigmoid)
+    """
+    return 1.0 / (1.0 + np.exp(-x))
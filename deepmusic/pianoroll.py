@@ -0,0 +1,112 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Compact piano roll representation
+
+"""
+
+import numpy as np
+
+import deepmusic.songstruct as music
+
+
+class PianoRoll:
+    """ Binary piano roll, bit-packed along the keyboard axis
+    The song is stored time-major as an uint8 array of shape [song_length, NB_BYTES] (one bit by key), so a
+    time slice stays contiguous in memory and only the windows actually used need to be unpacked.
+    Indexing a PianoRoll behave like indexing the dense [NB_NOTES, song_length] binary matrix.
+    """
+    NB_BYTES = (music.NB_NOTES + 7) // 8  # Nb of bytes for one keyboard configuration (11 for 88 keys)
+
+    def __init__(self, packed):
+        """
+        Args:
+            packed (np.array): the bit-packed notes of shape [song_length, NB_BYTES] (can be a memory mapped view)
+        """
+        assert packed.ndim == 2 and packed.shape[1] == PianoRoll.NB_BYTES
+        self.packed = packed
+
+    @staticmethod
+    def from_array(array):
+        """ Pack a dense piano roll
+        Args:
+            array (np.array): binary matrix of shape [NB_NOTES, song_length]
+        Return:
+            PianoRoll: the packed song
+        """
+        assert array.shape[0] == music.NB_NOTES
+        return PianoRoll(np.packbits(array.T != 0, axis=1))
+
+    @staticmethod
+    def from_notes(notes, steps, song_length):
+        """ Create a piano roll from a list of notes
+        Args:
+            notes (np.array): the relative notes (position on the keyboard)
+            steps (np.array): the time step of each note
+            song_length (int): nb of time steps of the song
+        Return:
+            PianoRoll: the packed song
+        """
+        piano_roll = np.zeros([song_length, music.NB_NOTES], dtype=bool)  # Time-major, so the packing is contiguous
+        piano_roll[steps, notes] = True  # Adding all notes at once
+        return PianoRoll(np.packbits(piano_roll, axis=1))
+
+    @property
+    def shape(self):
+        """ Shape of the equivalent dense array
+        """
+        return music.NB_NOTES, self.packed.shape[0]
+
+    @property
+    def nbytes(self):
+        """ Nb of bytes used to store the song
+        """
+        return self.packed.nbytes
+
+    @property
+    def dense_nbytes(self):
+        """ Nb of bytes the song would use as a dense int64 array
+        """
+        return music.NB_NOTES * self.packed.shape[0] * np.dtype(np.int64).itemsize
+
+    def get_window(self, start, length):
+        """ Unpack a time slice of the song
+        Args:
+            start (int): the first time step
+            length (int): nb of time steps to extract
+        Return:
+            np.array: binary matrix of shape [length, NB_NOTES] (Warning: time-major)
+        """
+        return np.unpackbits(self.packed[start:start+length], axis=1, count=music.NB_NOTES)
+
+    def to_array(self):
+        """ Unpack the whole song
+        Return:
+            np.array: binary matrix of shape [NB_NOTES, song_length]
+        """
+        return self.get_window(0, self.packed.shape[0]).T
+
+    def __getitem__(self, key):
+        """ Unpack a slice of the song. Only the time range given by the key is unpacked. Ex: song[:, start:end]
+        Args:
+            key (Tuple[slice, slice]): (notes, time) keys, as for a [NB_NOTES, song_length] array
+        Return:
+            np.array: the unpacked values
+        """
+        notes_key, time_key = key
+        if not isinstance(time_key, slice):  # Single time step: a [NB_NOTES] vector
+            return np.unpackbits(self.packed[time_key], count=music.NB_NOTES)[notes_key]
+        return np.unpackbits(self.packed[time_key], axis=1, count=music.NB_NOTES).T[notes_key]
@@ -0,0 +1,95 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Create the batches in background while the model is training
+
+"""
+
+import collections
+import concurrent.futures  # Background workers
+import time
+
+
+class BatchPrefetcher:
+    """ Iterator over batches which are created in background
+    The batches are created by a pool of worker threads (most of the work is done by numpy, which release the GIL)
+    and stored in a bounded queue: at most `depth` batches are prepared in advance, so the memory does not depend
+    on the epoch size. The batches are returned in the same order as the given samples.
+    """
+    def __init__(self, create_batch, samples, depth=2, nb_workers=1, nb_batches=None):
+        """
+        Args:
+            create_batch (fct): function which create a Batch from one element of samples
+            samples (Iterable): the description of each batch to create (can be infinite)
+            depth (int): nb of batches prepared in advance (0 to create the batches synchronously)
+            nb_workers (int): nb of threads creating the batches
+            nb_batches (int): nb of batches, if the samples are given as a generator (None if infinite)
+        """
+        self.create_batch = create_batch
+        self.nb_batches = len(samples) if hasattr(samples, '__len__') else nb_batches
+        self.samples = iter(samples)
+        self.depth = depth
+
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(1, nb_workers)) if depth > 0 else None
+        self.queue = collections.deque()  # The batches in preparation (futures)
+
+        self.wait_time = 0.0  # Total time (in seconds) the consumer has been waiting for the batches
+
+        self._fill()
+
+    def _fill(self):
+        """ Launch the creation of the next batches, until the queue is full
+        """
+        while len(self.queue) < self.depth:
+            try:
+                samples = next(self.samples)
+            except StopIteration:
+                break
+            self.queue.append(self.executor.submit(self.create_batch, samples))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        """ Return the next batch (block if the batch is not ready yet)
+        """
+        tic = time.perf_counter()
+        if self.executor is None:  # Synchronous mode
+            batch = self.create_batch(next(self.samples))
+        elif self.queue:
+            batch = self.queue.popleft().result()
+            self._fill()
+        else:
+            self.close()
+            raise StopIteration
+        self.wait_time += time.perf_counter() - tic
+        return batch
+
+    def __len__(self):
+        """ Return the nb of batches (only if the samples have a length)
+        """
+        if self.nb_batches is None:
+            raise TypeError('Infinite batch iterator')
+        return self.nb_batches
+
+    def close(self):
+        """ Cancel the batches in preparation and stop the workers
+        """
+        for future in self.queue:
+            future.cancel()
+        self.queue.clear()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,213 @@
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Choose which parts of the songs compose the batches
+
+"""
+
+import numpy as np
+
+
+class WindowSampler:
+    """ Randomly draw the extracts (song_id, start) of each batch
+    Only the positions of the next batch are drawn (nothing is materialized for the whole epoch). Each extract is
+    drawn uniformly among all the possible (song, start) pairs of the dataset, using the cumulative number of
+    starts of each song as index. The songs are so chosen proportionally to their length.
+    """
+    def __init__(self, songs_lengths, window_length, batch_size):
+        """
+        Args:
+            songs_lengths (List[int]): the length of each song of the set
+            window_length (int): the nb of time steps of each extract
+            batch_size (int): the nb of extracts by batch
+        """
+        self.batch_size = batch_size
+
+        songs_lengths = np.asarray(songs_lengths, dtype=np.int64)
+        self.nb_starts = np.maximum(songs_lengths - window_length + 1, 0)  # Nb of possible extracts for each song
+        self.cumulative_starts = np.cumsum(self.nb_starts)
+        self.nb_ignored = int(np.sum(self.nb_starts == 0))  # Songs too short for a single extract
+        if not self.cumulative_starts.size or not self.cumulative_starts[-1]:
+            raise ValueError('All songs are shorter than the sample length ({} time steps)'.format(window_length))
+
+        # Nb of batches by epoch: the number of extracts of a song is proportional to its length (2 times its length
+        # in number of samples)
+        sample_length = window_length - 1
+        self.epoch_size = int(np.sum(2*songs_lengths[self.nb_starts > 0] // sample_length)) // batch_size
+
+        self.rng = np.random.RandomState()  # Independent from the global generator
+
+    def draw(self):
+        """ Draw the extracts of the next batch
+        Return:
+            Tuple[np.array, np.array]: the songs ids and the starts of the extracts (arrays of shape [batch_size])
+        """
+        positions = self.rng.randint(self.cumulative_starts[-1], size=self.batch_size)  # Position among all extracts
+        songs_ids = np.searchsorted(self.cumulative_starts, positions, side='right')
+        starts = positions - (self.cumulative_starts[songs_ids] - self.nb_starts[songs_ids])
+        return songs_ids, starts
+
+    def get_state(self):
+        """ Return the position of the sampler, to resume the draws later (see set_state)
+        """
+        return self.rng.get_state()
+
+    def set_state(self, state):
+        """ Restore the position of the sampler: the next draws will be the same as when get_state was called
+        """
+        self.rng.set_state(state)
+
+
+class PackedSampler:
+    """ Cut the extracts from the concatenation of all songs
+    The songs are concatenated (in a random order, reshuffled at each pass) into a virtual infinite stream, which is
+    cut into consecutive windows. A window can so contain the end of a song and the beginning of the next ones: each
+    extract is returned as a list of segments. Contrary to WindowSampler, the songs shorter than the window are used
+    and no time step is padded.
+    """
+    def __init__(self, songs_lengths, window_length, batch_size):
+        """
+        Args:
+            songs_lengths (List[int]): the length of each song of the set
+            window_length (int): the nb of time steps of each extract
+            batch_size (int): the nb of extracts by batch
+        """
+        self.window_length = window_length
+        self.batch_size = batch_size
+
+        self.songs_lengths = np.asarray(songs_lengths, dtype=np.int64)
+        self.songs_ids = np.flatnonzero(self.songs_lengths > 0)
+        self.nb_ignored = len(self.songs_lengths) - len(self.songs_ids)  # Empty songs
+        if not len(self.songs_ids):
+            raise ValueError('All songs are empty')
+
+        # Nb of batches by epoch: one pass over the dataset. Two consecutive windows share one time step (the last
+        # target of one is the first input of the next), so each transition is learned once by pass.
+        self.epoch_size = max(1, int(np.sum(self.songs_lengths)) // ((window_length - 1) * batch_size))
+
+        self.rng = np.random.RandomState()  # Independent from the global generator
+        self.queue = np.zeros([0], dtype=np.int64)  # The next songs of the stream
+        self.offset = 0  # Position of the stream in the first song of the queue
+
+    def draw(self):
+        """ Cut the extracts of the next batch
+        Return:
+            List[List[Tuple[int, int, int]]]: for each extract, the segments (song_id, start, length) which compose it
+        """
+        extracts = []
+        for _ in range(self.batch_size):
+            extracts.append(self._next_window())
+        return extracts
+
+    def _next_window(self):
+        """ Cut the next window of the stream
+        The stream move forward by window_length-1 (the last time step is also the first of the next window)
+        """
+        segments = []
+        i = 0  # Position in the queue
+        start = self.offset
+        remaining = self.window_length
+        while remaining:
+            if i == len(self.queue):  # End of the pass: the next songs are shuffled again
+                self.queue = np.concatenate([self.queue, self.rng.permutation(self.songs_ids)])
+            song_id = int(self.queue[i])
+            length = min(remaining, int(self.songs_lengths[song_id]) - start)
+            segments.append((song_id, start, length))
+            remaining -= length
+            i += 1
+            start = 0
+
+        # Move the stream forward (drop the completed songs)
+        position = self.offset + self.window_length - 1
+        i = 0
+        while position >= self.songs_lengths[self.queue[i]]:
+            position -= self.songs_lengths[self.queue[i]]
+            i += 1
+        self.queue = self.queue[i:]
+        self.offset = int(position)
+
+        return segments
+
+    def get_state(self):
+        """ Return the position of the sampler, to resume the draws later (see set_state)
+        """
+        return self.rng.get_state(), self.queue.copy(), self.offset
+
+    def set_state(self, state):
+        """ Restore the position of the sampler: the next draws will be the same as when get_state was called
+        """
+        rng_state, queue, self.offset = state
+        self.rng.set_state(rng_state)
+        self.queue = queue.copy()
+
+
+class BucketSampler:
+    """ Draw the batches from several extract lengths (buckets)
+    For each batch, a length is chosen uniformly, then the extracts are drawn by the sampler of this length, so all
+    extracts of a batch have the same length.
+    """
+    def __init__(self, samplers):
+        """
+        Args:
+            samplers (Dict[int, Sampler]): the sampler (WindowSampler or PackedSampler) of each sample length
+        """
+        self.lengths = sorted(samplers.keys())
+        self.samplers = samplers
+
+        # Nb of batches by epoch: harmonic mean of the epoch sizes of each bucket, so an epoch covers on average the
+        # same nb of time steps whatever the chosen buckets (0 if no bucket has a complete batch)
+        if all(s.epoch_size == 0 for s in samplers.values()):
+            self.epoch_size = 0
+        else:
+            self.epoch_size = max(1, int(round(len(samplers) / sum(1.0 / max(1, s.epoch_size) for s in samplers.values()))))
+
+        self.rng = np.random.RandomState()  # Independent from the global generator
+
+    def draw(self):
+        """ Choose the length of the next batch and draw its extracts
+        Return:
+            Tuple[int, object]: the sample length and the extracts returned by the sampler of this length
+        """
+        if len(self.lengths) == 1:
+            length = self.lengths[0]
+        else:
+            length = self.lengths[self.rng.randint(len(self.lengths))]
+        return length, self.samplers[length].draw()
+
+    def draw_transpositions(self, batch_size):
+        """ Draw the pitch shift of each extract of the next batch (data augmentation)
+        The values are uniform on [0, 1) and mapped to a shift once the notes of the extract are known (the range of
+        possible transpositions depends on the lowest and highest notes played)
+        Args:
+            batch_size (int): the nb of extracts
+        Return:
+            np.array: the random values [batch_size]
+        """
+        return self.rng.random_sample(batch_size)
+
+    def get_state(self):
+        """ Return the position of the sampler, to resume the draws later (see set_state)
+        """
+        return self.rng.get_state(), {length: s.get_state() for length, s in self.samplers.items()}
+
+    def set_state(self, state):
+        """ Restore the position of the sampler: the next draws will be the same as when get_state was called
+        """
+        rng_state, samplers_states = state
+        self.rng.set_state(rng_state)
+        for length, sampler_state in samplers_states.items():
+            if length in self.samplers:  # The buckets may have changed
+                self.samplers[length].set_state(sampler_state)
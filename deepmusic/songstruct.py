@@ -16,6 +16,9 @@
 """
 Hierarchical data structures of a song
 """
+
+import numpy as np
+
 MIDI_NOTES_RANGE = [21, 108]  # Min and max (included) midi note on a piano
 # TODO: Warn/throw when we try to add a note outside this range
 # TODO: Easy conversion from this range to tensor vector id (midi_note2tf_id)
@@ -27,11 +30,15 @@ BAR_DIVISION = 16  # Nb of tics in a bar (What about waltz ? is 12 better ?)
 
 class Note:
     """ Structure which encapsulate the song data
+    Warning: Inside a track, the notes are stored as arrays (see Track). A Note object is a copy, modifying it after
+    it has been added to a track has no effect.
     """
-    def __init__(self):
-        self.tick = 0
-        self.note = 0
-        self.duration = 32  # TODO: Define the default duration / TODO: Use standard musical units (quarter note/eighth note) ?, don't convert here
+    __slots__ = ('tick', 'note', 'duration')
+
+    def __init__(self, tick=0, note=0, duration=32):
+        self.tick = tick
+        self.note = note
+        self.duration = duration  # TODO: Define the default duration / TODO: Use standard musical units (quarter note/eighth note) ?, don't convert here
 
     def get_relative_note(self):
         """ Convert the absolute midi position into the range given by MIDI_NOTES_RANGE
@@ -49,18 +56,125 @@ class Note:
         self.note = rel + MIDI_NOTES_RANGE[0]
 
 
+class NoteList:
+    """ List-like view over the notes of a track
+    Keep the compatibility with the Note interface: the Note objects are created on the fly when accessed.
+    """
+    __slots__ = ('_track',)
+
+    def __init__(self, track):
+        self._track = track
+
+    def __len__(self):
+        return self._track.nb_notes
+
+    def __iter__(self):
+        for tick, note, duration in zip(self._track.ticks.tolist(), self._track.pitches.tolist(), self._track.durations.tolist()):
+            yield Note(tick, note, duration)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Note(int(self._track.ticks[i]), int(self._track.pitches[i]), int(self._track.durations[i]))
+
+    def append(self, note):
+        self._track.add_note(note.tick, note.note, note.duration)
+
+    def extend(self, notes):
+        for note in notes:
+            self.append(note)
+
+
 class Track:
     """ Structure which encapsulate a track of the song
     Ideally, each track should correspond to a single instrument and one channel. Multiple tracks could correspond
     to the same channel if different instruments use the same channel.
+    The notes are stored by columns (one array for the ticks, midi notes and durations), which allow whole-track
+    operations. The arrays are over-allocated so adding a note is amortized O(1).
     """
+    __slots__ = ('instrument', 'is_drum', 'end_tick', 'nb_notes', '_ticks', '_pitches', '_durations')
+
+    DTYPE = np.int32  # Type used to store the notes attributes
+
     def __init__(self):
         #self.tempo_map = None  # Use a global tempo map
         self.instrument = None
-        self.notes = []  # List[Note]
         #self.color = (0, 0, 0)  # Color of the track for visual plotting
         self.is_drum = False
 
+        self.end_tick = 0  # Absolute tick when the last note end (updated each time a note is added)
+        self.nb_notes = 0
+        self._ticks = np.empty(0, dtype=Track.DTYPE)  # The first nb_notes values are used
+        self._pitches = np.empty(0, dtype=Track.DTYPE)
+        self._durations = np.empty(0, dtype=Track.DTYPE)
+
+    @property
+    def notes(self):
+        """ List[Note]: the notes of the track (list-like view)
+        """
+        return NoteList(self)
+
+    @property
+    def ticks(self):
+        """ np.array: the absolute tick of each note
+        """
+        return self._ticks[:self.nb_notes]
+
+    @property
+    def pitches(self):
+        """ np.array: the midi note of each note
+        """
+        return self._pitches[:self.nb_notes]
+
+    @property
+    def durations(self):
+        """ np.array: the duration (in ticks) of each note
+        """
+        return self._durations[:self.nb_notes]
+
+    def add_note(self, tick, note, duration):
+        """ Add a single note at the end of the track
+        Args:
+            tick (int): absolute time in tick from the beginning
+            note (int): the midi note
+            duration (int): nb of ticks
+        """
+        if self.nb_notes == len(self._ticks):  # Grow the arrays
+            self._reserve(max(16, 2*self.nb_notes))
+        self._ticks[self.nb_notes] = tick
+        self._pitches[self.nb_notes] = note
+        self._durations[self.nb_notes] = duration
+        self.nb_notes += 1
+        self.end_tick = max(self.end_tick, tick + duration)
+
+    def add_notes(self, ticks, notes, durations):
+        """ Add multiple notes at once
+        Args:
+            ticks (np.array): absolute time in tick from the beginning
+            notes (np.array): the midi notes
+            durations (np.array): nb of ticks (can also be a single value for all notes)
+        """
+        ticks = np.asarray(ticks)
+        nb_new_notes = len(ticks)
+        if not nb_new_notes:
+            return
+        if self.nb_notes + nb_new_notes > len(self._ticks):
+            self._reserve(max(self.nb_notes + nb_new_notes, 2*self.nb_notes))
+        new_slice = slice(self.nb_notes, self.nb_notes + nb_new_notes)
+        self._ticks[new_slice] = ticks
+        self._pitches[new_slice] = notes
+        self._durations[new_slice] = durations
+        self.nb_notes += nb_new_notes
+        self.end_tick = max(self.end_tick, int((self._ticks[new_slice] + self._durations[new_slice]).max()))
+
+    def _reserve(self, capacity):
+        """ Reallocate the notes arrays
+        """
+        for name in ('_ticks', '_pitches', '_durations'):
+            new_array = np.empty(capacity, dtype=Track.DTYPE)
+            new_array[:self.nb_notes] = getattr(self, name)[:self.nb_notes]
+            setattr(self, name, new_array)
+
     def set_instrument(self, msg):
         """ Initialize from a mido message
         Args:
@@ -88,6 +202,6 @@ class Song:
 
     def __len__(self):
         """ Return the absolute tick when the last note end
-        Note that the length is recomputed each time the function is called
+        The tracks keep track of their own length when notes are added, so the notes are not rescanned
         """
-        return max([max([n.tick + n.duration for n in t.notes]) for t in self.tracks])
+        return max([t.end_tick for t in self.tracks])
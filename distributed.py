@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Launch a distributed training on localhost: the parameter servers and the workers are started as separate processes
+of the main program. The other arguments are given to all processes. Ex:
+
+    python distributed.py --nb_workers 4 -- --model_tag distributed --batch_size 20
+
+On several machines, run main.py on each of them with the same --ps_hosts/--worker_hosts and its own
+--job_name/--task_index instead.
+
+Use python 3
+"""
+
+import argparse
+import socket
+import subprocess
+import sys
+
+
+def get_free_ports(nb_ports):
+    """ Reserve some ports on localhost
+    Args:
+        nb_ports (int): the nb of ports
+    Return:
+        List[int]: the free ports
+    """
+    sockets = [socket.socket() for _ in range(nb_ports)]
+    for s in sockets:
+        s.bind(('localhost', 0))  # Port chosen by the system
+    ports = [s.getsockname()[1] for s in sockets]
+    for s in sockets:
+        s.close()
+    return ports
+
+
+def launch_cluster(script_args, nb_workers, nb_ps=1, ports=None, stdout=None):
+    """ Start the processes of a localhost cluster
+    Args:
+        script_args (List[str]): the command of each process (ex: [python, main.py, options...]), the cluster options
+            are added
+        nb_workers (int): the nb of workers
+        nb_ps (int): the nb of parameter servers
+        ports (List[int]): the ports of the parameter servers then of the workers (free ports if None)
+        stdout: the standard output of the workers (ex: subprocess.PIPE to read it, the terminal by default)
+    Return:
+        List[subprocess.Popen], List[subprocess.Popen]: the parameter servers and the workers processes
+    """
+    ports = ports or get_free_ports(nb_ps + nb_workers)
+    hosts = ['localhost:{}'.format(port) for port in ports]
+    cluster_args = ['--ps_hosts'] + hosts[:nb_ps] + ['--worker_hosts'] + hosts[nb_ps:]
+
+    ps_processes = [
+        subprocess.Popen(script_args + cluster_args + ['--job_name', 'ps', '--task_index', str(i)])
+        for i in range(nb_ps)
+    ]
+    worker_processes = [
+        subprocess.Popen(script_args + cluster_args + ['--job_name', 'worker', '--task_index', str(i)], stdout=stdout)
+        for i in range(nb_workers)
+    ]
+    return ps_processes, worker_processes
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nb_workers', type=int, default=2, help='number of worker processes (the worker 0 is the chief)')
+    parser.add_argument('--nb_ps', type=int, default=1, help='number of parameter servers')
+    parser.add_argument('main_args', nargs=argparse.REMAINDER, help='arguments of the main program (after --)')
+    args = parser.parse_args()
+    main_args = [a for a in args.main_args if a != '--']
+
+    # The dataset is created first (otherwise, all workers would create it at the same time)
+    subprocess.check_call([sys.executable, 'main.py', '--create_dataset'] + main_args)
+
+    ps_processes, worker_processes = launch_cluster([sys.executable, 'main.py'] + main_args, args.nb_workers, args.nb_ps)
+    try:
+        for process in worker_processes:
+            process.wait()
+    except KeyboardInterrupt:  # Also received by the workers (same process group), which save and exit
+        for process in worker_processes:
+            process.wait()
+    finally:
+        for process in ps_processes:  # The parameter servers never stop by themselves
+            process.kill()
+
+
+if __name__ == '__main__':
+    main()
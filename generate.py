@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+# Copyright 2015 Conchylicultor. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+
+"""
+Generate songs from the exported models, without TensorFlow.
+The models have first to be exported with the main program: `python main.py --test export`. They can then be
+quantized in int8 with `python generate.py --quantize` (the quantized models are generated as the float ones)
+
+Use python 3
+"""
+
+import argparse
+import glob
+import os
+import time
+
+from deepmusic.musicdata import MusicData
+from deepmusic.midiconnector import MidiConnector
+from deepmusic.numpymodel import NumpyModel
+
+
+QUANTIZED_EXT = '-int8.npz'
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('models', type=str, nargs='*', help='the exported models (.npz), all the ones of model_dir if not set')
+    parser.add_argument('--model_dir', type=str, default='save/model', help='folder containing the exported models')
+    parser.add_argument('--generate_length', type=int, default=None, help='number of time steps of the generated songs (sample_length of the model if not set)')
+    parser.add_argument('--quantize', action='store_true', help='if set, the float models are converted to int8 (saved as <model>-int8.npz, 4 times smaller files, the weights are converted back to float when loaded so the generation speed is unchanged) instead of generating songs (see benchmark.py quantization for the quality report)')
+    args = parser.parse_args()
+
+    model_list = args.models or glob.glob(os.path.join(args.model_dir, '*.npz'))
+    if not model_list:
+        print('Warning: No exported model found in \'{}\'. Please export the models first (--test export)'.format(args.model_dir))
+        return
+
+    if args.quantize:
+        for model_name in sorted(model_list):
+            if model_name.endswith(QUANTIZED_EXT):
+                continue
+            quantized_name = model_name[:-len('.npz')] + QUANTIZED_EXT
+            NumpyModel.quantize(model_name, quantized_name)
+            print('{}: {:.1f}KB -> {:.1f}KB'.format(
+                quantized_name,
+                NumpyModel(model_name).stored_nbytes / 1024,
+                NumpyModel(quantized_name).stored_nbytes / 1024
+            ))
+        return
+
+    for model_name in sorted(model_list):
+        tic = time.perf_counter()
+        model = NumpyModel(model_name)
+        music_data = MusicData(argparse.Namespace(test=True, note_range=model.note_range))  # Dataset not loaded
+
+        batch, names = music_data.get_batches_test()
+        outputs = model.generate(batch.inputs, batch.initiator_lengths, args.generate_length)  # [generate_length, nb_initiators, nb_keys]
+
+        # Same files as the main program (midi only)
+        model_dir, model_filename = os.path.split(model_name)
+        model_dir = os.path.join(model_dir, 'midi')
+        for i, name in enumerate(names):
+            music_data.visit_recorder(
+                outputs[:, i:i+1],  # The song of this initiator only
+                model_dir,
+                model_filename[:-len('.npz')] + '-' + name,
+                [MidiConnector]
+            )
+        print('{}: {} songs generated in {:.2f}s'.format(model_name, len(names), time.perf_counter() - tic))
+
+
+if __name__ == '__main__':
+    main()